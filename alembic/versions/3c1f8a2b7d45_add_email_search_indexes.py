@@ -0,0 +1,41 @@
+"""Add email search vectors and pattern indexes
+
+Revision ID: 3c1f8a2b7d45
+Revises: 9267a77b40d9
+Create Date: 2026-10-19 10:02:11.418392
+
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = '3c1f8a2b7d45'
+down_revision: Union[str, None] = '9267a77b40d9'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+SEARCH_COLUMNS = ['from_address', 'to_address', 'subject']
+
+
+def upgrade() -> None:
+    for column in SEARCH_COLUMNS:
+        op.add_column('emails',
+                      sa.Column(f'{column}_search', postgresql.TSVECTOR(),
+                                sa.Computed(f"to_tsvector('simple', coalesce({column}, ''))", persisted=True),
+                                nullable=True)
+                      )
+        op.create_index(f'ix_emails_{column}_search', 'emails', [f'{column}_search'], unique=False,
+                        postgresql_using='gin')
+        op.create_index(f'ix_emails_{column}_pattern', 'emails', [column], unique=False,
+                        postgresql_ops={column: 'text_pattern_ops'})
+
+
+def downgrade() -> None:
+    for column in reversed(SEARCH_COLUMNS):
+        op.drop_index(f'ix_emails_{column}_pattern', table_name='emails')
+        op.drop_index(f'ix_emails_{column}_search', table_name='emails')
+        op.drop_column('emails', f'{column}_search')
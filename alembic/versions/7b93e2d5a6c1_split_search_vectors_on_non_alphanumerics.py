@@ -0,0 +1,44 @@
+"""Split email search vectors on non-alphanumeric characters
+
+Revision ID: 7b93e2d5a6c1
+Revises: f2c6d8a41e07
+Create Date: 2026-10-20 10:12:37.905214
+
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = '7b93e2d5a6c1'
+down_revision: Union[str, None] = 'f2c6d8a41e07'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+SEARCH_COLUMNS = ['from_address', 'to_address', 'subject']
+
+
+def replace_search_vector(column, expression):
+    # The expression of a generated column cannot be altered, so the column and its index are recreated
+    op.drop_index(f'ix_emails_{column}_search', table_name='emails')
+    op.drop_column('emails', f'{column}_search')
+    op.add_column('emails',
+                  sa.Column(f'{column}_search', postgresql.TSVECTOR(),
+                            sa.Computed(f"to_tsvector('simple', {expression})", persisted=True),
+                            nullable=True)
+                  )
+    op.create_index(f'ix_emails_{column}_search', 'emails', [f'{column}_search'], unique=False,
+                    postgresql_using='gin')
+
+
+def upgrade() -> None:
+    for column in SEARCH_COLUMNS:
+        replace_search_vector(column, f"regexp_replace(coalesce({column}, ''), '[^[:alnum:]]+', ' ', 'g')")
+
+
+def downgrade() -> None:
+    for column in SEARCH_COLUMNS:
+        replace_search_vector(column, f"coalesce({column}, '')")
@@ -0,0 +1,40 @@
+"""Add email ingest sequence and rule watermarks table
+
+Revision ID: f2c6d8a41e07
+Revises: d51b7e93c0a6
+Create Date: 2026-10-19 15:48:02.317564
+
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = 'f2c6d8a41e07'
+down_revision: Union[str, None] = 'd51b7e93c0a6'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.execute(sa.schema.CreateSequence(sa.Sequence('emails_ingest_seq')))
+    op.add_column('emails', sa.Column('ingest_seq', sa.BigInteger(),
+                                      server_default=sa.text("nextval('emails_ingest_seq')"), nullable=True))
+    # Existing rows get their sequence from the server default
+    op.create_index('ix_emails_ingest_seq', 'emails', ['ingest_seq'], unique=False)
+    op.create_table('rule_watermarks',
+                    sa.Column('rule_id', sa.String(), nullable=False),
+                    sa.Column('rule_version', sa.String(), nullable=False),
+                    sa.Column('last_seq', sa.BigInteger(), nullable=False),
+                    sa.Column('evaluated_at', sa.DateTime(), nullable=False),
+                    sa.PrimaryKeyConstraint('rule_id')
+                    )
+
+
+def downgrade() -> None:
+    op.drop_table('rule_watermarks')
+    op.drop_index('ix_emails_ingest_seq', table_name='emails')
+    op.drop_column('emails', 'ingest_seq')
+    op.execute(sa.schema.DropSequence(sa.Sequence('emails_ingest_seq')))
@@ -0,0 +1,278 @@
+import re
+from abc import ABC, abstractmethod
+
+from sqlalchemy import create_engine, event, false, func, or_, select, sql
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.pool import NullPool
+from sqlalchemy.schema import CreateColumn
+
+from db.models import Base, Email, SEARCH_CONFIG
+
+
+class StorageBackend(ABC):
+    """
+    Database specific parts of the email store: engine setup, schema creation, the bulk upsert used when
+    fetching emails and the expressions behind predicates that have no portable SQL form.
+    """
+    name = None
+    insert = None  # Dialect specific insert construct supporting ON CONFLICT
+    supports_skip_locked = False
+
+    @abstractmethod
+    def create_engine(self, uri):
+        """
+        Creates the SQLAlchemy engine for a database URI.
+        """
+
+    def ensure_schema(self, engine):
+        """
+        Creates the schema if the backend is not managed by Alembic migrations.
+        """
+        pass
+
+    def upsert_emails(self, connection, emails):
+        """
+        Inserts emails, updating the stored fields of the ones that already exist. Rows whose fields did not
+        change are left untouched, so their ingest_seq does not move.
+        :param
+            connection: The connection to execute the statement on.
+            emails: A list of dictionaries with the Email column values.
+        :return:
+        """
+        stmt = self.insert(Email).values(emails)
+        fields = ['from_address', 'to_address', 'subject', 'date_received']
+        upsert_stmt = stmt.on_conflict_do_update(
+            index_elements=['id'],
+            set_=self.upsert_values(stmt, fields),
+            where=or_(*[getattr(Email, field).is_distinct_from(stmt.excluded[field]) for field in fields])
+        )
+        connection.execute(upsert_stmt)
+
+    def upsert_values(self, stmt, fields):
+        """
+        The values set on an existing email by the upsert.
+        """
+        return {field: stmt.excluded[field] for field in fields}
+
+    def ingest_snapshot(self, session):
+        """
+        Returns the highest ingest_seq such that no email with a lower one can still become visible later.
+        :param session: The database session.
+        :return:
+            seq: The ingest_seq watermark, 0 if there are no emails.
+        """
+        return session.query(func.max(Email.ingest_seq)).scalar() or 0
+
+    @abstractmethod
+    def matches_words(self, column, value):
+        """
+        Full text match of every word in value against a string column of Email.
+        :param
+            column: The Email column to match against.
+            value: Free text, every word of which must be present.
+        :return:
+            The SQLAlchemy boolean expression.
+        """
+
+    @abstractmethod
+    def is_valid_regex(self, session, pattern):
+        """
+        Checks a "Matches regex" pattern with the regular expression engine the backend matches it with, since
+        an invalid pattern fails the whole query.
+        :param
+            session: The database session the rule is evaluated in, or None.
+            pattern: The regular expression.
+        :return:
+            bool: True if the backend accepts the pattern.
+        """
+
+    @staticmethod
+    def search_words(value):
+        """
+        Splits a value into the words matched by full text search: runs of letters and digits, like the
+        SEARCH_SEPARATOR used for the stored search vectors.
+        """
+        return re.findall(r'[^\W_]+', str(value or ''))
+
+
+class PostgresBackend(StorageBackend):
+    """
+    PostgreSQL backend. The schema is managed by Alembic and full text search uses the generated tsvector
+    columns of Email.
+    """
+    name = 'postgresql'
+    insert = staticmethod(postgresql.insert)
+    supports_skip_locked = True
+
+    def create_engine(self, uri):
+        return create_engine(
+            uri,
+            pool_recycle=3600,  # Recycle connections after one hour
+            pool_pre_ping=True,  # Check if connection is alive and reestablish it if necessary
+            echo=False,  # Turn off echo to reduce verbosity in logs
+            poolclass=NullPool  # Use NullPool for connection pooling (adjust based on your use case)
+        )
+
+    def upsert_values(self, stmt, fields):
+        values = super().upsert_values(stmt, fields)
+        values['ingest_seq'] = Email.__table__.c.ingest_seq.default.next_value()
+        return values
+
+    def ingest_snapshot(self, session):
+        # Sequence values are handed out before commit, so a lower value could still be committed after a
+        # higher one is visible. SHARE mode waits for every open transaction writing to emails to finish.
+        session.execute(sql.text('LOCK TABLE emails IN SHARE MODE'))
+        seq = super().ingest_snapshot(session)
+        session.commit()
+        return seq
+
+    def matches_words(self, column, value):
+        words = self.search_words(value)
+        if not words:
+            return false()
+
+        search_vector = getattr(Email, f'{column.key}_search')
+        return search_vector.bool_op('@@')(func.plainto_tsquery(SEARCH_CONFIG, ' '.join(words)))
+
+    def is_valid_regex(self, session, pattern):
+        if not isinstance(pattern, str):
+            return False
+        if session is None:
+            return True  # Nothing to probe with, an invalid pattern fails the query instead
+        try:
+            # Probe in a savepoint, PostgreSQL aborts the enclosing transaction on an error
+            with session.begin_nested():
+                session.execute(select(sql.literal('').regexp_match(pattern)))
+            return True
+        except DBAPIError:
+            return False
+
+
+class SQLiteBackend(StorageBackend):
+    """
+    Embedded SQLite backend for single node deployments. Runs in WAL mode so rule processing can read while
+    emails are being fetched, and backs full text search with an external content FTS5 table kept in sync
+    by triggers.
+    """
+    name = 'sqlite'
+    insert = staticmethod(sqlite.insert)
+
+    pragmas = {
+        'journal_mode': 'WAL',  # Readers do not block the writer and vice versa
+        'synchronous': 'NORMAL',  # Durable across application crashes, fsync only at checkpoints
+        'busy_timeout': 5000,  # Wait for a concurrent writer instead of failing with "database is locked"
+        'cache_size': -65536,  # 64 MB page cache
+        'temp_store': 'MEMORY',
+        'mmap_size': 268435456,  # Read pages through a 256 MB memory map
+        'foreign_keys': 'ON',
+        'case_sensitive_like': 'ON',  # LIKE is case sensitive on PostgreSQL
+    }
+
+    fts_columns = ['from_address', 'to_address', 'subject']
+
+    def create_engine(self, uri):
+        engine = create_engine(uri, echo=False)
+        event.listen(engine, 'connect', self.set_pragmas)
+        return engine
+
+    def set_pragmas(self, dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma, value in self.pragmas.items():
+            cursor.execute(f'PRAGMA {pragma} = {value}')
+        cursor.close()
+
+    def ensure_schema(self, engine):
+        columns = ', '.join(self.fts_columns)
+        new_values = ', '.join(f'new.{name}' for name in self.fts_columns)
+        old_values = ', '.join(f'old.{name}' for name in self.fts_columns)
+        statements = [
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS emails_fts USING fts5({columns}, content='emails', "
+            f"content_rowid='rowid', tokenize='unicode61 remove_diacritics 0')",
+            f"CREATE TRIGGER IF NOT EXISTS emails_fts_insert AFTER INSERT ON emails BEGIN "
+            f"INSERT INTO emails_fts(rowid, {columns}) VALUES (new.rowid, {new_values}); END",
+            f"CREATE TRIGGER IF NOT EXISTS emails_fts_delete AFTER DELETE ON emails BEGIN "
+            f"INSERT INTO emails_fts(emails_fts, rowid, {columns}) VALUES ('delete', old.rowid, {old_values}); END",
+            f"CREATE TRIGGER IF NOT EXISTS emails_fts_update AFTER UPDATE OF {columns} ON emails BEGIN "
+            f"INSERT INTO emails_fts(emails_fts, rowid, {columns}) VALUES ('delete', old.rowid, {old_values}); "
+            f"INSERT INTO emails_fts(rowid, {columns}) VALUES (new.rowid, {new_values}); END",
+            # SQLite has no sequences. Writes are serialized, so the next ingest_seq is one past the highest.
+            "CREATE TRIGGER IF NOT EXISTS emails_ingest_seq_insert AFTER INSERT ON emails BEGIN "
+            "UPDATE emails SET ingest_seq = (SELECT coalesce(max(ingest_seq), 0) + 1 FROM emails) "
+            "WHERE rowid = new.rowid; END",
+            "CREATE TRIGGER IF NOT EXISTS emails_ingest_seq_update "
+            "AFTER UPDATE OF from_address, to_address, subject, date_received ON emails BEGIN "
+            "UPDATE emails SET ingest_seq = (SELECT coalesce(max(ingest_seq), 0) + 1 FROM emails) "
+            "WHERE rowid = new.rowid; END",
+        ]
+        Base.metadata.create_all(engine)
+        with engine.begin() as connection:
+            self.add_missing_columns(connection)
+            has_fts = connection.exec_driver_sql(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'emails_fts'").first() is not None
+            for statement in statements:
+                connection.exec_driver_sql(statement)
+            if not has_fts:
+                # Emails stored before the index existed bypassed the triggers, index them from the content table
+                connection.exec_driver_sql("INSERT INTO emails_fts(emails_fts) VALUES ('rebuild')")
+
+    @staticmethod
+    def add_missing_columns(connection):
+        """
+        Adds the Email columns introduced after the database was created. create_all only creates missing tables.
+        """
+        existing = {row[1] for row in connection.exec_driver_sql('PRAGMA table_info(emails)')}
+        for email_column in Email.__table__.columns:
+            if email_column.name in existing or isinstance(email_column.type, postgresql.TSVECTOR):
+                continue
+            column_type = email_column.type.compile(dialect=connection.dialect)
+            connection.exec_driver_sql(f'ALTER TABLE emails ADD COLUMN {email_column.name} {column_type}')
+            if email_column.name == 'ingest_seq':
+                connection.exec_driver_sql('UPDATE emails SET ingest_seq = rowid')
+                connection.exec_driver_sql('CREATE INDEX IF NOT EXISTS ix_emails_ingest_seq ON emails (ingest_seq)')
+
+    def matches_words(self, column, value):
+        # Quote every word so FTS5 query syntax in the value is matched literally, like plainto_tsquery
+        words = self.search_words(value)
+        if not words:
+            return false()
+
+        fts = sql.table('emails_fts', sql.column('rowid'), sql.column(column.key))
+        match = fts.c[column.key].op('MATCH')(' '.join(f'"{word}"' for word in words))
+        return sql.literal_column('emails.rowid').in_(select(fts.c.rowid).where(match))
+
+    def is_valid_regex(self, session, pattern):
+        # SQLAlchemy implements REGEXP on SQLite with Python's re module
+        try:
+            re.compile(pattern)
+            return True
+        except (re.error, TypeError):
+            return False
+
+
+@compiles(CreateColumn, 'sqlite')
+def skip_search_vectors(element, compiler, **kw):
+    """
+    Leaves the PostgreSQL only tsvector columns out of the SQLite schema, which uses FTS5 instead.
+    """
+    if isinstance(element.element.type, postgresql.TSVECTOR):
+        return None
+    return compiler.visit_create_column(element, **kw)
+
+
+BACKENDS = {backend.name: backend for backend in [PostgresBackend, SQLiteBackend]}
+
+
+def get_backend(uri):
+    """
+    Returns the storage backend for a database URI.
+    :param uri: The SQLAlchemy database URI, e.g. 'sqlite:///happyfox.db'.
+    :return:
+        backend: A StorageBackend instance.
+    """
+    name = make_url(uri).get_backend_name()
+    if name not in BACKENDS:
+        raise ValueError(f"Unsupported database backend: {name}")
+    return BACKENDS[name]()
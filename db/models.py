@@ -1,8 +1,27 @@
-from sqlalchemy import Column, String, DateTime
+from sqlalchemy import Column, String, DateTime, Computed, Index, Integer, BigInteger, Sequence
+from sqlalchemy.dialects.postgresql import TSVECTOR
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import deferred
 
 Base = declarative_base()
 
+# Text search configuration used for the generated tsvector columns and the matching tsquery.
+# 'simple' lower-cases and splits on word boundaries without stemming or stop words.
+SEARCH_CONFIG = 'simple'
+
+# Anything but letters and digits separates words. Replacing it with spaces before to_tsvector stops the parser
+# from keeping email addresses and host names as single tokens, so words split the same way as SQLite's FTS5.
+SEARCH_SEPARATOR = '[^[:alnum:]]+'
+
+
+def search_vector(column_name):
+    """
+    Builds a generated tsvector column for the given text column. The column is deferred so that
+    it is never loaded into Python when querying emails.
+    """
+    expression = f"regexp_replace(coalesce({column_name}, ''), '{SEARCH_SEPARATOR}', ' ', 'g')"
+    return deferred(Column(TSVECTOR, Computed(f"to_tsvector('{SEARCH_CONFIG}', {expression})", persisted=True)))
+
 
 class Email(Base):
     __tablename__ = 'emails'
@@ -12,3 +31,85 @@ class Email(Base):
     to_address = Column(String)  # 'To' field
     subject = Column(String)  # Email subject
     date_received = Column(DateTime)  # Date when the email was received
+    # Increases whenever the email is inserted or changed, rule watermarks track the last one processed
+    ingest_seq = Column(BigInteger, Sequence('emails_ingest_seq'), index=True)
+
+    # Full text search vectors backing the "Matches words" predicate
+    from_address_search = search_vector('from_address')
+    to_address_search = search_vector('to_address')
+    subject_search = search_vector('subject')
+
+    __table_args__ = (
+        Index('ix_emails_from_address_search', 'from_address_search',
+              postgresql_using='gin').ddl_if(dialect='postgresql'),
+        Index('ix_emails_to_address_search', 'to_address_search',
+              postgresql_using='gin').ddl_if(dialect='postgresql'),
+        Index('ix_emails_subject_search', 'subject_search',
+              postgresql_using='gin').ddl_if(dialect='postgresql'),
+        # text_pattern_ops lets LIKE 'prefix%' ("Starts with") use a btree index regardless of collation
+        Index('ix_emails_from_address_pattern', 'from_address', postgresql_ops={'from_address': 'text_pattern_ops'}),
+        Index('ix_emails_to_address_pattern', 'to_address', postgresql_ops={'to_address': 'text_pattern_ops'}),
+        Index('ix_emails_subject_pattern', 'subject', postgresql_ops={'subject': 'text_pattern_ops'}),
+    )
+
+
+class RuleWorkItem(Base):
+    """
+    One (rule, ingest_seq range) slice of a parallel rule processing run. The worker processes of the run claim
+    pending items with FOR UPDATE SKIP LOCKED, so every item is processed by exactly one of them.
+    """
+    __tablename__ = 'rule_work_items'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    run_id = Column(String, nullable=False)  # Identifier of the processing run
+    rule_index = Column(Integer, nullable=False)  # Position of the rule in the rules list
+    bucket = Column(Integer, nullable=False)  # Position of the ingest_seq range in the run
+    min_seq = Column(BigInteger, nullable=False)  # The range covers emails with min_seq < ingest_seq <= max_seq
+    max_seq = Column(BigInteger, nullable=False)
+    status = Column(String, nullable=False, default='pending')  # pending | done
+    worker = Column(String)  # Worker that completed the item
+    matched = Column(Integer, nullable=False, default=0)  # Number of emails matched in the slice
+    unresolved_seq = Column(BigInteger)  # Lowest ingest_seq in the slice whose body could not be fetched
+    completed_at = Column(DateTime)  # When the item was completed
+
+    __table_args__ = (
+        Index('ix_rule_work_items_run_id_status', 'run_id', 'status'),
+    )
+
+
+class ActionOutbox(Base):
+    """
+    An action a rule matched, waiting to be applied to Gmail. Rows are written by the matching step and
+    drained by apply workers, which retry failures with backoff and dead-letter them after too many attempts.
+    """
+    __tablename__ = 'action_outbox'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    email_id = Column(String, nullable=False)  # Email the action applies to
+    rule_id = Column(String)  # Rule that matched the email
+    action = Column(String, nullable=False)  # Action name, e.g. 'Move Message'
+    folder = Column(String)  # Target folder of 'Move Message'
+    status = Column(String, nullable=False, default='pending')  # pending | in_progress | done | dead
+    attempts = Column(Integer, nullable=False, default=0)  # Number of failed attempts so far
+    last_error = Column(String)  # Error of the last failed attempt
+    available_at = Column(DateTime, nullable=False)  # Earliest time the next attempt may run, or claim expiry
+    created_at = Column(DateTime, nullable=False)  # When the action was matched
+    completed_at = Column(DateTime)  # When the action was applied or dead-lettered
+
+    __table_args__ = (
+        Index('ix_action_outbox_status_available_at', 'status', 'available_at'),
+    )
+
+
+class RuleWatermark(Base):
+    """
+    Progress of incremental rule evaluation: the last ingest sequence and evaluation time a rule version was
+    processed up to. Only emails ingested or changed after the watermark, or whose date crossed one of the
+    rule's date thresholds since then, need to be evaluated again.
+    """
+    __tablename__ = 'rule_watermarks'
+
+    rule_id = Column(String, primary_key=True)  # Rule id from rules.json
+    rule_version = Column(String, nullable=False)  # Hash of the rule definition
+    last_seq = Column(BigInteger, nullable=False)  # Highest ingest_seq processed
+    evaluated_at = Column(DateTime, nullable=False)  # Time the relative dates were evaluated against
@@ -7,10 +7,8 @@ from google.auth.transport.requests import Request
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
-from sqlalchemy.dialects.postgresql import insert
 
-from db.engine import Session, engine
-from db.models import Email
+from db.engine import Session, backend, engine
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
@@ -27,18 +25,19 @@ class GmailClient:
     functionality to fetch emails from the Gmail account.
     """
 
-    def __init__(self):
+    def __init__(self, credentials=None):
         """
         Initialize the GmailClient and authenticate the Gmail API.
+        :param credentials: Already authorized credentials. When omitted they are loaded or obtained through OAuth.
         """
-        self.service = self.authenticate_gmail()
+        self.service = self.build_service(credentials or self.get_credentials())
 
     @staticmethod
-    def authenticate_gmail():
+    def get_credentials():
         """
-        Handle OAuth authentication with the Gmail API.
+        Handle OAuth authentication with the Gmail API, refreshing or obtaining the token when needed.
         :return:
-            service: An authorized Gmail API service instance.
+            creds: Authorized, picklable OAuth credentials.
         """
         creds = None
         if os.path.exists(GmailConstants.TOKEN_FILE):
@@ -55,7 +54,26 @@ class GmailClient:
             with open(GmailConstants.TOKEN_FILE, 'wb') as token:
                 pickle.dump(creds, token)
 
-        return build('gmail', 'v1', credentials=creds)
+        return creds
+
+    @staticmethod
+    def build_service(credentials):
+        """
+        Builds a Gmail API service from authorized credentials.
+        :param credentials: Authorized OAuth credentials.
+        :return:
+            service: An authorized Gmail API service instance.
+        """
+        return build('gmail', 'v1', credentials=credentials)
+
+    @staticmethod
+    def authenticate_gmail():
+        """
+        Handle OAuth authentication with the Gmail API.
+        :return:
+            service: An authorized Gmail API service instance.
+        """
+        return GmailClient.build_service(GmailClient.get_credentials())
 
     def fetch_emails(self, max_emails=100):
         """
@@ -84,13 +102,15 @@ class GmailClient:
                         'from_address': headers.get('From', ''),
                         'to_address': headers.get('To', ''),
                         'subject': headers.get('Subject', ''),
-                        'date_received': parsed_date.strftime('%Y-%m-%d %H:%M:%S')
+                        'date_received': parsed_date.replace(tzinfo=None)
                     })
 
             emails_info = []
             batch = self.service.new_batch_http_request(callback=callback)
             for message_id in message_ids:
-                batch.add(self.service.users().messages().get(userId='me', id=message_id['id']))
+                # Only the headers are stored, bodies are fetched lazily by the rule processor when a rule needs them
+                batch.add(self.service.users().messages().get(userId='me', id=message_id['id'], format='metadata',
+                                                              metadataHeaders=['From', 'To', 'Subject', 'Date']))
 
             batch.execute()
 
@@ -110,20 +130,12 @@ def main():
         client = GmailClient()
         session = Session()
 
+        backend.ensure_schema(engine)
+
         emails = client.fetch_emails(max_emails=100)
         if emails:
             with engine.begin() as connection:
-                stmt = insert(Email).values(emails)
-                upsert_stmt = stmt.on_conflict_do_update(
-                    index_elements=['id'],
-                    set_={
-                        'from_address': stmt.excluded.from_address,
-                        'to_address': stmt.excluded.to_address,
-                        'subject': stmt.excluded.subject,
-                        'date_received': stmt.excluded.date_received
-                    }
-                )
-                connection.execute(upsert_stmt)
+                backend.upsert_emails(connection, emails)
                 logging.info("Bulk upsert completed successfully.")
         else:
             logging.info('No emails found.')
@@ -1,30 +1,52 @@
+import argparse
+import functools
 import logging
 
+from db.engine import backend
 from fetch_email import GmailClient
+from rule_processor.outbox import OutboxWorker
+from rule_processor.parallel import process_rules_parallel
 from rule_processor.rule_processor import RuleProcessor
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 
-def main():
+def main(workers=1, apply_options=None):
     """
     Main function to fetch and process emails based on defined rules.
+    :param
+        workers: Number of worker processes. Rules are processed in this process when 1.
+        apply_options: OutboxWorker keyword arguments for applying the queued actions after matching, or None
+            to leave them to standalone apply workers (python -m rule_processor.outbox).
     """
     try:
-        # Initialize the Gmail client
-        client = GmailClient()
-
-        # Initialize the RuleProcessor with the Gmail client's service
-        processor = RuleProcessor(client.service)
-
         # Read rules from the JSON file
-        rules = processor.read_rule_json()
+        rules = RuleProcessor.read_rule_json()
         if not rules:
             logging.error("No rules found or failed to read rules.")
             return
 
-        # Process rules
-        processor.process_rules(rules)
+        if workers > 1 and not backend.supports_skip_locked:
+            logging.warning(f"The {backend.name} backend does not support parallel workers, processing serially.")
+            workers = 1
+
+        if workers > 1:
+            # Authenticate once here, so workers never run the OAuth flow or write token.pickle concurrently.
+            # Each worker builds its own Gmail service and processor from the credentials.
+            credentials = GmailClient.get_credentials()
+            process_rules_parallel(rules, functools.partial(GmailClient.build_service, credentials), workers=workers,
+                                   apply_options=apply_options)
+        else:
+            # Initialize the Gmail client
+            client = GmailClient()
+
+            # Initialize the RuleProcessor with the Gmail client's service
+            processor = RuleProcessor(client.service)
+
+            # Process rules, then apply the queued actions
+            processor.process_rules(rules)
+            if apply_options is not None:
+                OutboxWorker(processor, **apply_options).drain()
         logging.info("Finished processing rules.")
 
     except Exception as e:
@@ -32,5 +54,15 @@ def main():
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Process emails based on the rules in rules.json')
+    parser.add_argument('--workers', type=int, default=1, help='Number of worker processes')
+    parser.add_argument('--no-apply', action='store_true',
+                        help='Only queue actions, leaving them to standalone apply workers')
+    parser.add_argument('--rate-limit', type=float, default=None,
+                        help='Maximum actions applied per second, shared by all workers')
+    parser.add_argument('--batch-size', type=int, default=50, help='Actions claimed at once')
+    args = parser.parse_args()
+
     # Run the main function
-    main()
+    main(workers=args.workers,
+         apply_options=None if args.no_apply else {'rate_limit': args.rate_limit, 'batch_size': args.batch_size})
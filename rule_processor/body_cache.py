@@ -0,0 +1,194 @@
+import hashlib
+import json
+import logging
+import mmap
+import os
+import tempfile
+import zlib
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+class BodyCache:
+    """
+    Content addressed on-disk cache of email bodies. Bodies are stored zlib compressed under the SHA-256 of
+    their content, so identical bodies are stored once, and every message id has a small ref file pointing
+    at its body along with the metadata needed by the body predicates. When the bodies grow past max_bytes
+    the least recently used ones are evicted along with the refs pointing at them.
+    Several processes can share a cache directory. Each one only counts the bodies it writes itself, so the
+    cache can grow past max_bytes until one of them reaches the limit; eviction then rescans the directory.
+    """
+    CHUNK_SIZE = 64 * 1024
+    # Eviction frees some headroom below max_bytes, so it and the walk over the refs don't run on every write
+    EVICT_TO = 0.9
+
+    def __init__(self, directory=None, max_bytes=None):
+        """
+        :param
+            directory: Cache directory. Defaults to the BODY_CACHE_DIR env variable or '.body_cache'.
+            max_bytes: Size limit of the stored bodies. Defaults to the BODY_CACHE_MAX_BYTES env variable or 256 MB.
+        """
+        self.directory = directory or os.environ.get('BODY_CACHE_DIR', '.body_cache')
+        self.max_bytes = max_bytes or int(os.environ.get('BODY_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+        self.objects_dir = os.path.join(self.directory, 'objects')
+        self.refs_dir = os.path.join(self.directory, 'refs')
+        # Size of the stored bodies as seen by this process, scanned from disk on first write and on eviction
+        self.total_bytes = None
+
+    def object_path(self, digest):
+        return os.path.join(self.objects_dir, digest[:2], digest)
+
+    def ref_path(self, message_id):
+        return os.path.join(self.refs_dir, message_id)
+
+    @staticmethod
+    def write_atomic(path, data):
+        """
+        Writes data to path through a temporary file, so readers never see a partially written file.
+        """
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as file:
+            file.write(data)
+        os.replace(tmp_path, path)
+
+    def put(self, message_id, body, has_attachment=False):
+        """
+        Stores the body of a message.
+        :param
+            message_id: The Gmail message id.
+            body: The body text as bytes.
+            has_attachment: Whether the message has attachments.
+        :return:
+        """
+        digest = hashlib.sha256(body).hexdigest()
+        path = self.object_path(digest)
+        if not os.path.exists(path):
+            compressed = zlib.compress(body)
+            self.write_atomic(path, compressed)
+            if self.total_bytes is None:
+                self.total_bytes = sum(size for _, size, _ in self.scan_objects())
+            else:
+                self.total_bytes += len(compressed)
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+
+        ref = {'digest': digest, 'size': len(body), 'has_attachment': has_attachment}
+        self.write_atomic(self.ref_path(message_id), json.dumps(ref).encode())
+
+    def get(self, message_id):
+        """
+        Looks up the cached body of a message.
+        :param message_id: The Gmail message id.
+        :return:
+            ref: A dictionary with the body digest, size and has_attachment, or None on a miss.
+        """
+        try:
+            with open(self.ref_path(message_id), 'rb') as file:
+                ref = json.loads(file.read())
+            # Refresh the access time used for eviction
+            os.utime(self.object_path(ref['digest']))
+            return ref
+        except (FileNotFoundError, ValueError, KeyError):
+            return None
+
+    def contains(self, message_id, needle):
+        """
+        Searches the cached body of a message for a substring. The compressed body is memory-mapped and
+        decompressed in chunks, so large bodies are never held in memory as a whole.
+        :param
+            message_id: The Gmail message id.
+            needle: The bytes to look for.
+        :return:
+            found: True if the body contains needle, None if the body is not cached.
+        """
+        ref = self.get(message_id)
+        if ref is None:
+            return None
+        if not needle:
+            return True
+
+        try:
+            with open(self.object_path(ref['digest']), 'rb') as file:
+                if os.fstat(file.fileno()).st_size == 0:
+                    return False  # pragma: no cover
+                with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    tail = b''
+                    for chunk in self.decompressed_chunks(mapped):
+                        data = tail + chunk
+                        if needle in data:
+                            return True
+                        # Keep enough of the end to find a needle spanning two chunks
+                        tail = data[-(len(needle) - 1):] if len(needle) > 1 else b''
+                    return False
+        except FileNotFoundError:
+            return None
+
+    def decompressed_chunks(self, compressed):
+        """
+        Decompresses a body in chunks of at most CHUNK_SIZE bytes, however well it compressed.
+        :param compressed: The compressed body, e.g. a memory map of its object file.
+        :return:
+            A generator of decompressed chunks.
+        """
+        decompressor = zlib.decompressobj()
+        for offset in range(0, len(compressed), self.CHUNK_SIZE):
+            data = compressed[offset:offset + self.CHUNK_SIZE]
+            while data:
+                yield decompressor.decompress(data, self.CHUNK_SIZE)
+                data = decompressor.unconsumed_tail
+        while not decompressor.eof:
+            chunk = decompressor.decompress(b'', self.CHUNK_SIZE)
+            if not chunk:
+                break  # pragma: no cover
+            yield chunk
+
+    def scan_objects(self):
+        """
+        Lists the stored bodies as (last access time, size, path) tuples.
+        """
+        entries = []
+        for root, _, files in os.walk(self.objects_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue  # Evicted or renamed into place by another process
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def evict(self):
+        """
+        Removes the least recently used bodies until the cache is within EVICT_TO of max_bytes, then the refs
+        pointing at bodies that are gone. The total is recomputed from disk first, since other processes sharing
+        the directory may have added or evicted bodies.
+        """
+        entries = sorted(self.scan_objects())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes * self.EVICT_TO:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass  # Already evicted by another process
+            total -= size
+            logging.debug(f"Evicted cached body {path}")
+        self.total_bytes = total
+        self.remove_dangling_refs()
+
+    def remove_dangling_refs(self):
+        """
+        Removes the refs whose body has been evicted, by this or another process.
+        """
+        for root, _, files in os.walk(self.refs_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    with open(path, 'rb') as file:
+                        digest = json.loads(file.read())['digest']
+                    if not os.path.exists(self.object_path(digest)):
+                        os.remove(path)
+                except (FileNotFoundError, ValueError, KeyError):
+                    continue  # Removed by another process, or a temporary file still being written
@@ -0,0 +1,6 @@
+class PermanentActionError(Exception):
+    """
+    Raised when an action can never succeed, e.g. it is unknown, its folder does not exist or its message was
+    deleted. Retrying it is pointless, so the outbox dead-letters it right away.
+    """
+    pass
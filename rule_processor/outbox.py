@@ -0,0 +1,218 @@
+import argparse
+import datetime
+import logging
+import time
+from collections import Counter
+
+from sqlalchemy import or_, select, update
+
+from db.engine import Session
+from db.models import ActionOutbox, Email
+from rule_processor.exceptions import PermanentActionError
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+def enqueue_actions(session, email, rule):
+    """
+    Queues every action of the rule for the email. The rows are committed with the caller's transaction.
+    :param
+        session: The database session used for matching.
+        email: The email object the rule matched.
+        rule: A dictionary representing a rule with a list of actions.
+    :return:
+    """
+    now = datetime.datetime.now()
+    for action in rule.get('actions', []):
+        session.add(ActionOutbox(
+            email_id=email.id,
+            rule_id=str(rule.get('id')),
+            action=action.get('action'),
+            folder=action.get('folder'),
+            status='pending',
+            attempts=0,
+            available_at=now,
+            created_at=now
+        ))
+
+
+def claim_batch(session, batch_size, lease_seconds):
+    """
+    Claims a batch of due actions by marking them in progress, and commits the claim so no rows stay locked
+    while the actions are applied. The conditional UPDATE is atomic on every backend, so concurrent apply
+    workers never claim the same action. A claim expires after lease_seconds, which returns the actions of
+    a worker that died to the queue.
+    :param
+        session: The apply worker's database session.
+        batch_size: The maximum number of actions to claim.
+        lease_seconds: How long the claimed actions stay reserved for this worker.
+    :return:
+        items: A list of ActionOutbox rows.
+    """
+    now = datetime.datetime.now()
+    claimable = [or_(ActionOutbox.status == 'pending', ActionOutbox.status == 'in_progress'),
+                 ActionOutbox.available_at <= now]
+    due = session.scalars(select(ActionOutbox.id)
+                          .where(*claimable)
+                          .order_by(ActionOutbox.id)
+                          .limit(batch_size)
+                          .with_for_update(skip_locked=True)).all()
+    if not due:
+        session.commit()
+        return []
+
+    # Checking claimable again skips the actions another worker claimed since they were selected
+    stmt = (update(ActionOutbox)
+            .where(ActionOutbox.id.in_(due), *claimable)
+            .values(status='in_progress', available_at=now + datetime.timedelta(seconds=lease_seconds))
+            .returning(ActionOutbox))
+    items = session.scalars(stmt, execution_options={'synchronize_session': False}).all()
+    session.commit()
+    return sorted(items, key=lambda item: item.id)
+
+
+class OutboxWorker:
+    """
+    Drains the action outbox in batches, applying each action through the RuleProcessor. Failed actions are
+    retried with exponential backoff and dead-lettered once they run out of attempts or can never succeed.
+    """
+
+    def __init__(self, processor, batch_size=50, max_attempts=5, backoff_seconds=30, rate_limit=None,
+                 lease_seconds=300):
+        """
+        :param
+            processor: The RuleProcessor used to apply actions.
+            batch_size: The number of actions claimed at once.
+            max_attempts: The number of failed attempts after which an action is dead-lettered.
+            backoff_seconds: The delay before the first retry, doubled on every further attempt.
+            rate_limit: The maximum number of actions this worker applies per second, or None for no limit.
+            lease_seconds: How long claimed actions stay reserved, on top of the time the rate limit spreads a
+                batch over. Actions of a worker that died are claimed again once it has passed.
+        """
+        self.processor = processor
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+        self.min_interval = 1.0 / rate_limit if rate_limit else 0
+        self.lease_seconds = lease_seconds + batch_size * self.min_interval
+        self.last_applied = 0
+
+    def throttle(self):
+        """
+        Sleeps as long as needed to keep the applied actions under the rate limit.
+        """
+        wait = self.last_applied + self.min_interval - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        self.last_applied = time.monotonic()
+
+    def apply(self, item, email):
+        """
+        Applies one outbox action and records the outcome on its row.
+        :param
+            item: The ActionOutbox row.
+            email: The Email the action applies to.
+        :return:
+            status: 'done', 'retry' or 'dead'.
+        """
+        now = datetime.datetime.now()
+        try:
+            if email is None:
+                raise PermanentActionError(f"Email not found: {item.email_id}")
+
+            self.throttle()
+            self.processor.apply_action(email, {'action': item.action, 'folder': item.folder})
+            item.status = 'done'
+            item.completed_at = now
+            return 'done'
+        except Exception as e:
+            item.attempts += 1
+            item.last_error = str(e)
+            if isinstance(e, PermanentActionError) or item.attempts >= self.max_attempts:
+                item.status = 'dead'
+                item.completed_at = now
+                logging.error(f"Dead-lettered action {item.id} {item.action} for email {item.email_id}: {e}")
+                return 'dead'
+
+            delay = self.backoff_seconds * 2 ** (item.attempts - 1)
+            item.status = 'pending'
+            item.available_at = now + datetime.timedelta(seconds=delay)
+            logging.warning(f"Retrying action {item.id} {item.action} for email {item.email_id} in {delay}s")
+            return 'retry'
+
+    def run_batch(self):
+        """
+        Claims and applies one batch of actions. The outcome of every action is committed as soon as it is known,
+        so a worker that dies only repeats the action it was applying.
+        :return:
+            stats: A Counter of outcomes, empty if there was nothing to apply.
+        """
+        stats = Counter()
+        with Session() as session:
+            items = claim_batch(session, self.batch_size, self.lease_seconds)
+            if not items:
+                return stats
+
+            email_ids = {item.email_id for item in items}
+            emails = {email.id: email for email in session.query(Email).filter(Email.id.in_(email_ids))}
+
+            for item in items:
+                stats[self.apply(item, emails.get(item.email_id))] += 1
+                session.commit()
+        return stats
+
+    def drain(self):
+        """
+        Applies batches until no due action is left. Actions waiting for a retry are left for a later drain.
+        :return:
+            stats: A Counter of outcomes across all batches.
+        """
+        stats = Counter()
+        while True:
+            batch_stats = self.run_batch()
+            if not batch_stats:
+                break
+            stats.update(batch_stats)
+        logging.info(f"Outbox drained: {dict(stats)}")
+        return stats
+
+    def run_forever(self, poll_interval=5):
+        """
+        Keeps applying actions as they become due, so retries run on time even when no rules are being processed.
+        Runs until interrupted.
+        :param poll_interval: Seconds to wait before polling again once the outbox has no due actions.
+        :return:
+        """
+        logging.info(f"Outbox worker started, polling every {poll_interval}s")
+        try:
+            while True:
+                if not self.run_batch():
+                    time.sleep(poll_interval)
+        except KeyboardInterrupt:
+            logging.info("Outbox worker stopped.")
+
+
+def main():
+    """
+    Runs a standalone apply worker. Any number of them can run next to rule processing, on any host.
+    """
+    parser = argparse.ArgumentParser(description='Apply the actions queued in the action outbox')
+    parser.add_argument('--rate-limit', type=float, default=None,
+                        help='Maximum actions applied per second by this worker')
+    parser.add_argument('--batch-size', type=int, default=50, help='Actions claimed at once')
+    parser.add_argument('--max-attempts', type=int, default=5, help='Failed attempts before dead-lettering')
+    parser.add_argument('--poll-interval', type=float, default=5, help='Seconds between polls of an empty outbox')
+    args = parser.parse_args()
+
+    # Imported here, as the rule processor itself queues actions through this module
+    from fetch_email import GmailClient
+    from rule_processor.rule_processor import RuleProcessor
+
+    processor = RuleProcessor(GmailClient().service)
+    worker = OutboxWorker(processor, batch_size=args.batch_size, max_attempts=args.max_attempts,
+                          rate_limit=args.rate_limit)
+    worker.run_forever(poll_interval=args.poll_interval)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,232 @@
+import datetime
+import logging
+import uuid
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+from sqlalchemy import func, or_, select
+
+from db.engine import Session, backend as default_backend
+from db.models import Email, RuleWorkItem
+from rule_processor.outbox import OutboxWorker, enqueue_actions
+from rule_processor.rule_processor import RuleProcessor
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+def seq_ranges(session, scope, snapshot_seq, buckets):
+    """
+    Splits the emails in scope into ranges of ingest_seq holding about the same number of emails. Workers select
+    the emails of a range through the ingest_seq index, so a run scans the emails no more often than a serial run.
+    :param
+        session: The database session.
+        scope: Filter expression selecting the emails any of the rules needs to evaluate.
+        snapshot_seq: The highest ingest_seq the run processes.
+        buckets: The number of ranges to split the emails into.
+    :return:
+        ranges: A list of (min_seq, max_seq) tuples, each covering min_seq < ingest_seq <= max_seq. Together they
+            cover every ingest_seq up to snapshot_seq.
+    """
+    tiles = select(Email.ingest_seq,
+                   func.ntile(buckets).over(order_by=Email.ingest_seq).label('tile')).where(scope).subquery()
+    upper_bounds = session.scalars(select(func.max(tiles.c.ingest_seq))
+                                   .group_by(tiles.c.tile)
+                                   .order_by(tiles.c.tile)).all()
+
+    ranges = []
+    min_seq = 0
+    for max_seq in upper_bounds[:-1]:
+        ranges.append((min_seq, max_seq))
+        min_seq = max_seq
+    ranges.append((min_seq, snapshot_seq))
+    return ranges
+
+
+def enqueue_work(run_id, rules, ranges):
+    """
+    Creates one pending work item for every (rule, ingest_seq range) pair of the run.
+    :param
+        run_id: Identifier of the processing run.
+        rules: A list of rule dictionaries.
+        ranges: The (min_seq, max_seq) ranges the emails are split into.
+    :return:
+        count: The number of work items created.
+    """
+    items = [RuleWorkItem(run_id=run_id, rule_index=rule_index, bucket=bucket, min_seq=min_seq, max_seq=max_seq,
+                          status='pending', matched=0)
+             for rule_index in range(len(rules)) for bucket, (min_seq, max_seq) in enumerate(ranges)]
+    with Session() as session:
+        session.add_all(items)
+        session.commit()
+    return len(items)
+
+
+def delete_work(run_id):
+    """
+    Deletes the work items of a finished run.
+    :param run_id: Identifier of the processing run.
+    :return:
+    """
+    with Session() as session:
+        session.query(RuleWorkItem).filter(RuleWorkItem.run_id == run_id).delete()
+        session.commit()
+
+
+def unresolved_seqs(run_id):
+    """
+    Collects the lowest unresolved ingest_seq of every rule from the completed work items of a run.
+    :param run_id: Identifier of the processing run.
+    :return:
+        seqs: A dictionary of rule index to the lowest ingest_seq whose body could not be fetched.
+    """
+    with Session() as session:
+        rows = (session.query(RuleWorkItem.rule_index, func.min(RuleWorkItem.unresolved_seq))
+                .filter(RuleWorkItem.run_id == run_id, RuleWorkItem.unresolved_seq.isnot(None))
+                .group_by(RuleWorkItem.rule_index)
+                .all())
+    return dict(rows)
+
+
+def pending_work(run_id):
+    """
+    Counts the work items of a run that have not been completed.
+    :param run_id: Identifier of the processing run.
+    :return:
+        count: The number of items that are pending or were claimed by a worker that did not finish them.
+    """
+    with Session() as session:
+        return (session.query(RuleWorkItem)
+                .filter(RuleWorkItem.run_id == run_id, RuleWorkItem.status != 'done')
+                .count())
+
+
+def claim_work_item(session, run_id):
+    """
+    Claims the next pending work item of the run. The row stays locked until the session's transaction
+    ends, so concurrent workers skip it, and it returns to the queue if the worker dies before committing.
+    :param
+        session: The worker's database session.
+        run_id: Identifier of the processing run.
+    :return:
+        item: The claimed RuleWorkItem or None if the run has no pending work left.
+    """
+    return (session.query(RuleWorkItem)
+            .filter(RuleWorkItem.run_id == run_id, RuleWorkItem.status == 'pending')
+            .order_by(RuleWorkItem.id)
+            .with_for_update(skip_locked=True)
+            .first())
+
+
+def run_worker(run_id, rules, service_factory, worker, snapshot_seq, now, apply_options=None):
+    """
+    Drains work items of the run until none are left, matching each slice and queueing its actions in the
+    outbox, then optionally drains the outbox alongside the other workers.
+    :param
+        run_id: Identifier of the processing run.
+        rules: A list of rule dictionaries.
+        service_factory: A picklable callable returning an authorized Gmail API service.
+        worker: Name of this worker, recorded on the items it completes.
+        snapshot_seq: The highest ingest_seq the run processes.
+        now: The time relative dates are evaluated against.
+        apply_options: OutboxWorker keyword arguments for draining the outbox, or None to leave the queued
+            actions to standalone apply workers.
+    :return:
+        results: A dictionary of rule id to the number of emails matched by this worker.
+    """
+    processor = RuleProcessor(service_factory())
+    results = Counter()
+
+    while True:
+        with Session() as session:
+            item = claim_work_item(session, run_id)
+            if item is None:
+                break
+
+            rule = rules[item.rule_index]
+            query = session.query(Email).filter(Email.ingest_seq > item.min_seq, Email.ingest_seq <= item.max_seq,
+                                                processor.incremental_scope(session, rule, snapshot_seq, now))
+            unresolved = []
+            emails = processor.match_emails(query, rule, now, unresolved)
+            for email in emails:
+                enqueue_actions(session, email, rule)
+
+            item.status = 'done'
+            item.worker = worker
+            item.matched = len(emails)
+            item.unresolved_seq = min((email.ingest_seq for email in unresolved), default=None)
+            item.completed_at = datetime.datetime.now()
+            session.commit()
+
+            results[rule.get('id')] += len(emails)
+            logging.debug(f"Worker {worker} processed rule {rule.get('id')} bucket {item.bucket}: {len(emails)}")
+
+    if apply_options is not None:
+        OutboxWorker(processor, **apply_options).drain()
+    return dict(results)
+
+
+def merge_results(results):
+    """
+    Merges the per worker results into totals per rule.
+    :param results: A list of dictionaries of rule id to matched count.
+    :return:
+        totals: A dictionary of rule id to the total number of matched emails.
+    """
+    totals = Counter()
+    for result in results:
+        totals.update(result)
+    return dict(totals)
+
+
+def process_rules_parallel(rules, service_factory, workers=4, buckets=None, apply_options=None):
+    """
+    Processes rules with a pool of worker processes, each claiming (rule, ingest_seq range) slices of the emails.
+    Rule watermarks are advanced once every work item of the run is done, so a failed run is redone in full
+    next time.
+    :param
+        rules: A list of rule dictionaries.
+        service_factory: A picklable callable returning an authorized Gmail API service.
+        workers: The number of worker processes.
+        buckets: The number of ingest_seq ranges. Defaults to four per worker to even out skewed slices.
+        apply_options: OutboxWorker keyword arguments for draining the outbox in the workers, or None to leave
+            the queued actions to standalone apply workers. The rate limit is shared by all the workers.
+    :return:
+        totals: A dictionary of rule id to the total number of matched emails.
+    """
+    buckets = buckets or workers * 4
+    if apply_options and apply_options.get('rate_limit'):
+        apply_options = dict(apply_options, rate_limit=apply_options['rate_limit'] / workers)
+    run_id = uuid.uuid4().hex
+    now = datetime.datetime.now()
+    processor = RuleProcessor(service_factory())
+    with Session() as session:
+        snapshot_seq = default_backend.ingest_snapshot(session)
+        scope = or_(*[processor.incremental_scope(session, rule, snapshot_seq, now) for rule in rules])
+        ranges = seq_ranges(session, scope, snapshot_seq, buckets)
+    count = enqueue_work(run_id, rules, ranges)
+    logging.info(f"Run {run_id}: {count} work items across {workers} workers")
+
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(run_worker, run_id, rules, service_factory, f'{run_id}-{n}', snapshot_seq, now,
+                                   apply_options)
+                       for n in range(workers)]
+            results = [future.result() for future in futures]
+        # Advancing the watermarks past a slice nobody completed would skip its emails for good
+        incomplete = pending_work(run_id)
+        if incomplete:
+            raise RuntimeError(f"Run {run_id} left {incomplete} work items incomplete, watermarks not advanced")
+        unresolved = unresolved_seqs(run_id)
+    finally:
+        # Items of a failed run are never resumed, a new run starts from its own items
+        delete_work(run_id)
+
+    with Session() as session:
+        for rule_index, rule in enumerate(rules):
+            RuleProcessor.save_watermark(session, rule, snapshot_seq, now, unresolved.get(rule_index))
+        session.commit()
+
+    totals = merge_results(results)
+    for rule in rules:
+        logging.info(f"Rule {rule.get('id')} matched {totals.get(rule.get('id'), 0)} emails")
+    return totals
@@ -1,24 +1,36 @@
+import base64
 import datetime
+import hashlib
 import json
 import logging
 import os
 
-from sqlalchemy import or_, and_
+from googleapiclient.errors import HttpError
+from sqlalchemy import or_, and_, false
 from sqlalchemy.sql import operators
 
-from db.engine import Session
-from db.models import Email
+from db.engine import Session, backend as default_backend
+from db.models import Email, RuleWatermark
+from rule_processor.body_cache import BodyCache
+from rule_processor.exceptions import PermanentActionError
+from rule_processor.outbox import enqueue_actions
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 
 class RuleProcessor:
-    def __init__(self, gmail_service):
+    def __init__(self, gmail_service, backend=None, body_cache=None):
         self.gmail_service = gmail_service
+        # Storage backend providing the database specific predicates
+        self.backend = backend or default_backend
+        # Cache of the lazily fetched bodies used by the body predicates
+        self.body_cache = body_cache or BodyCache()
         self.available_labels = self.get_labels()
         # Field
         self.string_fields = ["From", "To", "Subject"]
         self.date_fields = ["Received"]
+        # Fields evaluated on the message body, which is only fetched for emails the other conditions don't rule out
+        self.body_fields = ["Body", "Has attachment"]
 
         self.field_to_db_mapping = {
             "From": "from_address",
@@ -32,7 +44,10 @@ class RuleProcessor:
             "Contains": operators.contains_op,
             "Does not Contain": operators.notcontains_op,
             "Equals": operators.eq,
-            "Does not equal": operators.ne
+            "Does not equal": operators.ne,
+            "Starts with": self.starts_with,
+            "Matches regex": operators.regexp_match_op,
+            "Matches words": self.matches_words
         }
 
         # Predicate - date
@@ -72,6 +87,24 @@ class RuleProcessor:
             logging.error(f"Unexpected error reading file: {filename} - {e}")
             return None
 
+    def matches_words(self, column, value):
+        """
+        Full text match of all the words in value against a column, using the storage backend's text index.
+        :param
+            column: The Email column to match against.
+            value: Free text, every word of which must be present.
+        :return:
+            The SQLAlchemy boolean expression.
+        """
+        return self.backend.matches_words(column, value)
+
+    @staticmethod
+    def starts_with(column, value):
+        """
+        Prefix match of value against a column. LIKE wildcards in the value are matched literally.
+        """
+        return column.startswith(value, autoescape=True)
+
     def get_string_comparison_operator(self, predicate):
         try:
             return self.string_comparison_operator.get(predicate)
@@ -100,11 +133,12 @@ class RuleProcessor:
             return None
 
     @staticmethod
-    def parse_date(value):
+    def parse_date(value, now=None):
         """
         Parses a relative date string and returns a datetime object.
         :param
             value:A string representing the relative time period.
+            now: The time the period is relative to. Defaults to the current time.
         :return:
             datetime.datetime: A datetime object representing the calculated past date.
         """
@@ -112,10 +146,11 @@ class RuleProcessor:
             # Assuming the value format is '30 days', '2 months', etc.
             num, period = value.split()
             num = int(num)
+            now = now or datetime.datetime.now()
             if period == 'days':
-                comparison_date = datetime.datetime.now() - datetime.timedelta(days=num)
+                comparison_date = now - datetime.timedelta(days=num)
             elif period == 'months':
-                comparison_date = datetime.datetime.now() - datetime.timedelta(days=30 * num)  # Approximation
+                comparison_date = now - datetime.timedelta(days=30 * num)  # Approximation
             else:
                 raise ValueError("Unsupported time period")
 
@@ -125,6 +160,16 @@ class RuleProcessor:
             return None
 
     def apply_action(self, email, action):
+        """
+        Applies a single action to an email in the email service.
+        :param
+            email: The email object representing the email to be modified.
+            action: A dictionary with the action name and its arguments.
+        :return:
+        :raises
+            PermanentActionError: If the action can never succeed, e.g. it is unknown or its folder does not exist.
+            Exception: Any other error from the email service, which may succeed when retried.
+        """
         try:
             if action['action'] == 'Mark as read':
                 self.mark_email_read_status(email, True)
@@ -133,9 +178,10 @@ class RuleProcessor:
             elif action['action'] == 'Move Message':
                 self.move_message(email, action.get('folder'))
             else:
-                logging.warning(f'Unknown action: {action}')
+                raise PermanentActionError(f'Unknown action: {action}')
         except Exception as e:  # pragma: no cover
             logging.error(f'Error applying action {action} to email {email}: {e}')
+            raise
 
     def mark_email_read_status(self, email, mark_as_read):
         """
@@ -160,6 +206,7 @@ class RuleProcessor:
         except Exception as e:  # pragma: no cover
             action = 'read' if mark_as_read else 'unread'
             logging.error(f"Error marking email as {action}: {email.id} - {e}")
+            self.raise_action_error(e)
 
     def move_message(self, email, folder):
         """
@@ -170,6 +217,12 @@ class RuleProcessor:
         :return:
         """
         try:  # pragma: no cover
+            if self.available_labels is None:
+                # Labels could not be loaded at startup, a missing label would not mean the folder doesn't exist
+                self.available_labels = self.get_labels()
+                if self.available_labels is None:
+                    raise RuntimeError(f"Labels unavailable, cannot resolve folder: {folder}")
+
             # Retrieve the label ID corresponding to the folder name
             label_id = self.get_label_id(folder)
             if label_id:
@@ -182,9 +235,22 @@ class RuleProcessor:
                 logging.info(
                     f"Email moved to folder: {folder} - Email ID: {email.id} {email.from_address}, {email.subject}")
             else:
-                logging.warning(f"Label not found for folder: {folder}")
+                raise PermanentActionError(f"Label not found for folder: {folder}")
         except Exception as e:  # pragma: no cover
             logging.error(f"Error moving email to folder: {folder} - Email ID: {email.id} - {e}")
+            self.raise_action_error(e)
+
+    @staticmethod
+    def raise_action_error(error):
+        """
+        Re-raises an error from applying an action, as a PermanentActionError if retrying cannot help.
+        :param error: The error raised while applying the action.
+        :return:
+        """
+        if isinstance(error, HttpError) and error.resp.status in (400, 404):
+            # Bad request or the message no longer exists
+            raise PermanentActionError(str(error)) from error
+        raise error
 
     def get_labels(self):  # pragma: no cover
         try:
@@ -215,28 +281,245 @@ class RuleProcessor:
 
     def process_rules(self, rules):
         """
-         Processes a list of rules against emails in the database and applies specified actions.
+         Processes a list of rules against emails in the database and queues the specified actions
+         in the action outbox. The actions are applied by draining the outbox.
         :param
             rules: A list of rule dictionaries.
         :return:
 
         """
         with Session() as session:
+            now = datetime.datetime.now()
+            snapshot_seq = self.backend.ingest_snapshot(session)
             for rule in rules:
                 logging.info(f"Processing Rule {rule.get('id')}::{rule.get('description')}")
-                query = self.build_query(session.query(Email), rule)
-                emails = query.all()
-                logging.debug(f"Query: {query}, Email List: {len(emails)}")
+                query = session.query(Email).filter(self.incremental_scope(session, rule, snapshot_seq, now))
+                unresolved = []
+                emails = self.match_emails(query, rule, now, unresolved)
                 for email in emails:
-                    for action in rule.get('actions', []):
-                        self.apply_action(email, action)
+                    enqueue_actions(session, email, rule)
+                # The watermark commits together with the queued actions
+                self.save_watermark(session, rule, snapshot_seq, now,
+                                    min((email.ingest_seq for email in unresolved), default=None))
+                session.commit()
+
+    @staticmethod
+    def rule_version(rule):
+        """
+        Hashes the parts of a rule that decide what it matches and does.
+        :param rule: A rule dictionary.
+        :return:
+            version: A hex digest that changes whenever the rule definition changes.
+        """
+        definition = {key: rule.get(key) for key in ['overall_predicate', 'conditions', 'actions']}
+        return hashlib.sha256(json.dumps(definition, sort_keys=True).encode()).hexdigest()
+
+    @classmethod
+    def rule_key(cls, rule):
+        return str(rule['id']) if rule.get('id') is not None else cls.rule_version(rule)
+
+    def incremental_scope(self, session, rule, snapshot_seq, now):
+        """
+        Restricts a rule run to the emails whose match result may have changed since the rule's watermark:
+        emails ingested or changed since then, and emails whose date crossed one of the rule's relative date
+        thresholds as they moved from the last evaluation to now. Without a watermark for the current rule
+        version every email is in scope.
+        :param
+            session: The database session.
+            rule: A rule dictionary.
+            snapshot_seq: The highest ingest_seq this run processes.
+            now: The time relative dates are evaluated against.
+        :return:
+            The SQLAlchemy filter expression.
+        """
+        in_snapshot = Email.ingest_seq <= snapshot_seq
+        watermark = session.get(RuleWatermark, self.rule_key(rule))
+        if watermark is None or watermark.rule_version != self.rule_version(rule):
+            logging.info(f"Full scan for rule {rule.get('id')}")
+            return in_snapshot
+
+        scopes = [Email.ingest_seq > watermark.last_seq]
+        for condition in rule.get('conditions', []):
+            if condition.get('field') in self.date_fields and condition.get('value'):
+                previous = self.parse_date(condition['value'], watermark.evaluated_at)
+                current = self.parse_date(condition['value'], now)
+                if previous and current and previous < current:
+                    scopes.append(and_(Email.date_received >= previous, Email.date_received < current))
+        return and_(in_snapshot, or_(*scopes))
+
+    @classmethod
+    def save_watermark(cls, session, rule, snapshot_seq, now, unresolved_seq=None):
+        """
+        Records that the rule has been processed up to snapshot_seq with relative dates evaluated at now.
+        When the result of some emails is unknown because their body could not be fetched, the watermark is
+        held just below the lowest of them, so the next run evaluates them again.
+        :param
+            session: The database session, committed by the caller.
+            rule: A rule dictionary.
+            snapshot_seq: The highest ingest_seq processed.
+            now: The time relative dates were evaluated against.
+            unresolved_seq: The lowest ingest_seq of the emails left unresolved, or None if there are none.
+        :return:
+        """
+        last_seq = snapshot_seq
+        if unresolved_seq is not None and unresolved_seq <= snapshot_seq:
+            last_seq = unresolved_seq - 1
+            logging.warning(f"Rule {rule.get('id')} left emails unresolved, holding its watermark at {last_seq}")
+        session.merge(RuleWatermark(rule_id=cls.rule_key(rule), rule_version=cls.rule_version(rule),
+                                    last_seq=last_seq, evaluated_at=now))
+
+    def match_emails(self, query, rule, now=None, unresolved=None):
+        """
+        Returns the emails selected by the base query that satisfy the rule. Body conditions are evaluated
+        after the database query, fetching bodies only for the emails the other conditions don't decide.
+        :param
+            query: The base SQLAlchemy query object, optionally narrowed to a slice of the emails.
+            rule: A dictionary representing a rule with conditions and overall predicate.
+            now: The time relative dates are evaluated against. Defaults to the current time.
+            unresolved: Optional list the emails are appended to whose body was needed but not available.
+                They are left out of the result, although they might match.
+        :return:
+            emails: A list of matching Email objects.
+        """
+        conditions = rule.get('conditions', [])
+        body_conditions = [condition for condition in conditions if condition.get('field') in self.body_fields]
+        if not body_conditions:
+            query = self.build_query(query, rule, now)
+            emails = query.all()
+            logging.debug(f"Query: {query}, Email List: {len(emails)}")
+            return emails
+
+        metadata_rule = dict(rule, conditions=[condition for condition in conditions
+                                               if condition.get('field') not in self.body_fields])
+
+        if rule.get('overall_predicate', 'All') == 'Any':
+            # Emails matching a metadata condition match the rule, the rest depend on their body
+            matched_ids = set()
+            if metadata_rule['conditions']:
+                matched_ids = {email.id for email in self.build_query(query, metadata_rule, now).all()}
+            emails = query.all()
+            candidates = [email for email in emails if email.id not in matched_ids]
+            matched_ids.update(email.id for email in self.match_bodies(candidates, body_conditions, any, unresolved))
+            return [email for email in emails if email.id in matched_ids]
+
+        candidates = self.build_query(query, metadata_rule, now).all()
+        return self.match_bodies(candidates, body_conditions, all, unresolved)
+
+    def match_bodies(self, emails, conditions, combine, unresolved=None):
+        """
+        Fetches the missing bodies of the emails and returns the ones whose body satisfies the conditions.
+        :param
+            emails: A list of Email objects.
+            conditions: The condition dictionaries on the body fields.
+            combine: all or any, depending on the overall predicate of the rule.
+            unresolved: Optional list the emails are appended to whose body is not available.
+        :return:
+            emails: A list of matching Email objects.
+        """
+        self.ensure_bodies(emails)
+        matched = []
+        for email in emails:
+            results = [self.evaluate_body_condition(email, condition) for condition in conditions]
+            if None in results:
+                if unresolved is not None:
+                    unresolved.append(email)
+            elif combine(results):
+                matched.append(email)
+        return matched
+
+    def evaluate_body_condition(self, email, condition):
+        """
+        Evaluates a body condition against the cached body of an email.
+        :param
+            email: The email object.
+            condition: A condition dictionary on one of the body fields.
+        :return:
+            bool: True if the condition holds, False if it doesn't. None if the body is not available.
+        """
+        field, predicate, value = condition.get('field'), condition.get('predicate'), condition.get('value')
+        if field == 'Body' and predicate in ('Contains', 'Does not Contain'):
+            found = self.body_cache.contains(email.id, str(value).encode())
+            if found is None:
+                logging.warning(f"Body not available for email: {email.id}")
+                return None
+            return found if predicate == 'Contains' else not found
+        elif field == 'Has attachment' and predicate in ('Equals', 'Does not equal'):
+            ref = self.body_cache.get(email.id)
+            if ref is None:
+                logging.warning(f"Body not available for email: {email.id}")
+                return None
+            expected = value is True or str(value).lower() == 'true'
+            return (ref['has_attachment'] == expected) == (predicate == 'Equals')
 
-    def build_query(self, query, rule):
+        logging.warning(f'Unknown body condition: {condition}')
+        return False
+
+    def ensure_bodies(self, emails):
+        """
+        Fetches the bodies of the emails that are not in the body cache yet.
+        :param emails: A list of Email objects.
+        :return:
+        """
+        missing = [email.id for email in emails if self.body_cache.get(email.id) is None]
+        if missing:
+            logging.info(f"Fetching {len(missing)} email bodies")
+            self.fetch_bodies(missing)
+
+    def fetch_bodies(self, message_ids, batch_size=100):
+        """
+        Fetches message bodies from the email service in batches and stores them in the body cache.
+        :param
+            message_ids: The ids of the messages to fetch.
+            batch_size: The number of requests per batch. Gmail allows at most 100.
+        :return:
+        """
+        def callback(request_id, response, exception):
+            if exception is not None:
+                logging.error(f'Error fetching email body: {exception}')
+            else:
+                body, has_attachment = self.parse_message_body(response.get('payload', {}))
+                self.body_cache.put(response['id'], body, has_attachment)
+
+        for start in range(0, len(message_ids), batch_size):
+            try:
+                batch = self.gmail_service.new_batch_http_request(callback=callback)
+                for message_id in message_ids[start:start + batch_size]:
+                    batch.add(self.gmail_service.users().messages().get(userId='me', id=message_id, format='full'))
+                batch.execute()
+            except Exception as e:  # pragma: no cover
+                logging.error(f'Error fetching email bodies: {e}')
+
+    @staticmethod
+    def parse_message_body(payload):
+        """
+        Extracts the text body of a message and whether it has attachments.
+        :param
+            payload: The payload of a Gmail message in 'full' format.
+        :return:
+            body: The text/plain parts, or the text/html parts if there are none, as bytes.
+            has_attachment: True if any part is an attachment.
+        """
+        texts = {'text/plain': [], 'text/html': []}
+        has_attachment = False
+        parts = [payload]
+        while parts:
+            part = parts.pop(0)
+            body = part.get('body', {})
+            if part.get('filename') and body.get('attachmentId'):
+                has_attachment = True
+            elif part.get('mimeType') in texts and body.get('data'):
+                texts[part['mimeType']].append(base64.urlsafe_b64decode(body['data']))
+            parts.extend(part.get('parts', []))
+
+        return b'\n'.join(texts['text/plain'] or texts['text/html']), has_attachment
+
+    def build_query(self, query, rule, now=None):
         """
         Build a query based on the given rule.
         :param
             query: The base SQLAlchemy query object.
             rule: A dictionary representing a rule with conditions and overall predicate.
+            now: The time relative dates are evaluated against. Defaults to the current time.
         :return:
             query: The modified query object with applied conditions.
         """
@@ -253,15 +536,26 @@ class RuleProcessor:
                     continue
 
                 field = condition['field']
+                if field in self.body_fields:
+                    # Evaluated on the fetched body by match_emails
+                    continue
+
                 db_field = self.field_to_db_mapping.get(field)
                 if db_field:
                     comparison_operator = self.get_comparison_operator(field, condition['predicate'])
                     value = condition['value']
 
                     if field in self.date_fields:
-                        value = self.parse_date(value)
+                        value = self.parse_date(value, now)
                         logging.debug(f"Parsed Datetime {value}")
 
+                    if (condition['predicate'] == 'Matches regex' and
+                            not self.backend.is_valid_regex(getattr(query, 'session', None), value)):
+                        # Dropping the condition would widen an 'All' rule, so it matches nothing instead
+                        logging.warning(f'Invalid regex, the condition never matches: {condition}')
+                        condition_expressions.append(false())
+                        continue
+
                     if comparison_operator:
                         condition_expr = comparison_operator(getattr(Email, db_field), value)
                         condition_expressions.append(condition_expr)
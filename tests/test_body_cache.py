@@ -0,0 +1,132 @@
+import os
+import tempfile
+import unittest
+import zlib
+from unittest.mock import patch
+
+from rule_processor.body_cache import BodyCache
+
+
+class TestBodyCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache = BodyCache(self.directory.name, max_bytes=1024 * 1024)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_get_miss(self):
+        self.assertIsNone(self.cache.get('message_id_1'))
+        self.assertIsNone(self.cache.contains('message_id_1', b'invoice'))
+
+    def test_put_and_contains(self):
+        self.cache.put('message_id_1', b'Your invoice is attached', has_attachment=True)
+
+        self.assertTrue(self.cache.get('message_id_1')['has_attachment'])
+        self.assertTrue(self.cache.contains('message_id_1', b'invoice'))
+        self.assertFalse(self.cache.contains('message_id_1', b'Invoice'))
+
+    def test_contains_across_chunks(self):
+        self.cache.CHUNK_SIZE = 16
+        body = os.urandom(4096).hex().encode() + b'needle' + os.urandom(4096).hex().encode()
+        self.cache.put('message_id_1', body)
+
+        self.assertTrue(self.cache.contains('message_id_1', b'needle'))
+        self.assertFalse(self.cache.contains('message_id_1', b'haystack'))
+
+    def test_decompressed_chunks_are_bounded(self):
+        self.cache.CHUNK_SIZE = 1024
+        body = b'0' * 1024 * 1024 + b'needle'
+        compressed = zlib.compress(body)
+        # The whole body compresses into a single chunk
+        self.assertLess(len(compressed), self.cache.CHUNK_SIZE * 2)
+
+        chunks = list(self.cache.decompressed_chunks(compressed))
+
+        self.assertLessEqual(max(len(chunk) for chunk in chunks), self.cache.CHUNK_SIZE)
+        self.assertEqual(b''.join(chunks), body)
+
+        self.cache.put('message_id_1', body)
+        self.assertTrue(self.cache.contains('message_id_1', b'needle'))
+
+    def test_identical_bodies_stored_once(self):
+        self.cache.put('message_id_1', b'Same newsletter')
+        self.cache.put('message_id_2', b'Same newsletter')
+
+        self.assertEqual(self.cache.get('message_id_1')['digest'], self.cache.get('message_id_2')['digest'])
+        self.assertEqual(len(self.cache.scan_objects()), 1)
+
+    def test_eviction(self):
+        self.cache.max_bytes = 3000
+        for n in range(3):
+            self.cache.put(f'message_id_{n}', os.urandom(1200))
+            os.utime(self.cache.object_path(self.cache.get(f'message_id_{n}')['digest']), (n, n))
+
+        self.assertIsNone(self.cache.get('message_id_0'))
+        self.assertIsNotNone(self.cache.get('message_id_2'))
+        self.assertLessEqual(self.cache.total_bytes, 3000)
+        # Refs of evicted bodies are removed with them
+        self.assertEqual(sorted(os.listdir(self.cache.refs_dir)), ['message_id_1', 'message_id_2'])
+
+    def test_eviction_counts_bodies_of_other_processes(self):
+        self.cache.max_bytes = 3000
+        other = BodyCache(self.directory.name, max_bytes=3000)
+        self.cache.put('message_id_0', os.urandom(1200))
+        other.put('message_id_1', os.urandom(1200))
+        self.cache.put('message_id_2', os.urandom(1200))
+        self.cache.put('message_id_3', os.urandom(1200))
+
+        stored = sum(size for _, size, _ in self.cache.scan_objects())
+        self.assertLessEqual(stored, 3000)
+        self.assertEqual(self.cache.total_bytes, stored)
+
+    def test_eviction_of_already_removed_body(self):
+        self.cache.put('message_id_0', os.urandom(1200))
+        self.cache.put('message_id_1', os.urandom(1200))
+        self.cache.max_bytes = 1500
+
+        remove = os.remove
+
+        def racing_remove(path):
+            if path.startswith(self.cache.objects_dir):
+                remove(path)  # Evicted by another process just before
+            remove(path)
+
+        with patch('rule_processor.body_cache.os.remove', side_effect=racing_remove):
+            self.cache.evict()
+
+        self.assertLessEqual(self.cache.total_bytes, 1500)
+
+    def test_scan_objects_skips_removed_files(self):
+        self.cache.put('message_id_0', b'First body')
+        self.cache.put('message_id_1', b'Second body')
+        removed = self.cache.object_path(self.cache.get('message_id_0')['digest'])
+        stat = os.stat
+
+        def racing_stat(path, *args, **kwargs):
+            if path == removed:
+                raise FileNotFoundError(path)
+            return stat(path, *args, **kwargs)
+
+        with patch('rule_processor.body_cache.os.stat', side_effect=racing_stat):
+            entries = self.cache.scan_objects()
+
+        remaining = self.cache.object_path(self.cache.get('message_id_1')['digest'])
+        self.assertEqual([path for _, _, path in entries], [remaining])
+
+    def test_remove_dangling_refs(self):
+        self.cache.put('message_id_0', b'First body')
+        self.cache.put('message_id_1', b'Second body')
+        os.remove(self.cache.object_path(self.cache.get('message_id_0')['digest']))
+        # A ref still being written is left alone
+        with open(os.path.join(self.cache.refs_dir, 'tmp_partial'), 'wb') as file:
+            file.write(b'{"dig')
+
+        self.cache.remove_dangling_refs()
+
+        self.assertEqual(sorted(os.listdir(self.cache.refs_dir)), ['message_id_1', 'tmp_partial'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -65,6 +65,18 @@ class TestGmailClient(unittest.TestCase):
         # Assertions
         self.assertEqual(emails, [])
 
+    @patch('fetch_email.GmailClient.get_credentials')
+    @patch('fetch_email.build')
+    def test_init_with_credentials(self, mock_build, mock_get_credentials):
+        credentials = MagicMock()
+
+        gmail_client = GmailClient(credentials=credentials)
+
+        # Given credentials are used as is, without touching the token file or the OAuth flow
+        mock_get_credentials.assert_not_called()
+        mock_build.assert_called_once_with('gmail', 'v1', credentials=credentials)
+        self.assertEqual(gmail_client.service, mock_build.return_value)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,150 @@
+import datetime
+import os
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+
+from sqlalchemy.orm import sessionmaker
+
+from db.backends import SQLiteBackend
+from db.models import ActionOutbox
+from rule_processor.exceptions import PermanentActionError
+from rule_processor.outbox import OutboxWorker, enqueue_actions
+
+
+class TestOutbox(unittest.TestCase):
+
+    def setUp(self):
+        self.processor = MagicMock()
+        self.worker = OutboxWorker(self.processor, max_attempts=3, backoff_seconds=10)
+        self.mock_email = MagicMock()
+        self.item = ActionOutbox(id=1, email_id='message_id_1', action='Mark as read', status='pending',
+                                 attempts=0, available_at=datetime.datetime.now())
+
+    def test_enqueue_actions(self):
+        session = MagicMock()
+        self.mock_email.id = 'message_id_1'
+        rule = {'id': 1, 'actions': [{'action': 'Mark as read'}, {'action': 'Move Message', 'folder': 'Work'}]}
+
+        enqueue_actions(session, self.mock_email, rule)
+
+        rows = [call.args[0] for call in session.add.call_args_list]
+        self.assertEqual([row.action for row in rows], ['Mark as read', 'Move Message'])
+        self.assertEqual(rows[1].folder, 'Work')
+        self.assertTrue(all(row.status == 'pending' for row in rows))
+
+    def test_apply_success(self):
+        status = self.worker.apply(self.item, self.mock_email)
+
+        self.assertEqual(status, 'done')
+        self.assertEqual(self.item.status, 'done')
+        self.processor.apply_action.assert_called_once_with(self.mock_email, {'action': 'Mark as read',
+                                                                              'folder': None})
+
+    def test_apply_retries_with_backoff(self):
+        self.processor.apply_action.side_effect = Exception("Rate limit exceeded")
+
+        status = self.worker.apply(self.item, self.mock_email)
+
+        self.assertEqual(status, 'retry')
+        self.assertEqual(self.item.status, 'pending')
+        self.assertEqual(self.item.attempts, 1)
+        self.assertGreater(self.item.available_at, datetime.datetime.now() + datetime.timedelta(seconds=5))
+
+    def test_apply_dead_letters_after_max_attempts(self):
+        self.processor.apply_action.side_effect = Exception("Backend error")
+        self.item.attempts = 2
+
+        status = self.worker.apply(self.item, self.mock_email)
+
+        self.assertEqual(status, 'dead')
+        self.assertEqual(self.item.last_error, 'Backend error')
+
+    def test_apply_dead_letters_permanent_errors(self):
+        self.processor.apply_action.side_effect = PermanentActionError("Label not found for folder: Missing")
+
+        status = self.worker.apply(self.item, self.mock_email)
+
+        self.assertEqual(status, 'dead')
+        self.assertEqual(self.item.attempts, 1)
+
+    def test_apply_retries_other_errors(self):
+        self.processor.apply_action.side_effect = ValueError("Unexpected response")
+
+        status = self.worker.apply(self.item, self.mock_email)
+
+        self.assertEqual(status, 'retry')
+
+    @patch('rule_processor.outbox.time.sleep')
+    def test_run_forever_polls_until_stopped(self, mock_sleep):
+        self.worker.run_batch = MagicMock(side_effect=[{'done': 2}, {}, {'retry': 1}, {}, KeyboardInterrupt])
+
+        self.worker.run_forever(poll_interval=7)
+
+        self.assertEqual(self.worker.run_batch.call_count, 5)
+        self.assertEqual(mock_sleep.call_args_list, [((7,),), ((7,),)])
+
+    @patch('rule_processor.outbox.time.sleep')
+    def test_rate_limit(self, mock_sleep):
+        worker = OutboxWorker(self.processor, rate_limit=2)
+
+        worker.throttle()
+        worker.throttle()
+
+        self.assertAlmostEqual(mock_sleep.call_args.args[0], 0.5, places=1)
+
+
+class TestOutboxWorkerRun(unittest.TestCase):
+    """
+    Applies queued actions from an SQLite database.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.backend = SQLiteBackend()
+        self.engine = self.backend.create_engine(f"sqlite:///{os.path.join(self.directory.name, 'happyfox.db')}")
+        self.backend.ensure_schema(self.engine)
+        with self.engine.begin() as connection:
+            self.backend.upsert_emails(connection, [
+                {'id': f'message_id_{n}', 'from_address': 'billing@canarabank.com', 'to_address': 'me@example.com',
+                 'subject': f'Statement {n}', 'date_received': datetime.datetime.now()} for n in range(3)])
+
+        self.session_factory = sessionmaker(bind=self.engine)
+        with self.session_factory() as session:
+            rule = {'id': 1, 'actions': [{'action': 'Mark as read'}]}
+            for n in range(3):
+                enqueue_actions(session, MagicMock(id=f'message_id_{n}'), rule)
+            session.commit()
+
+        self.patcher = patch('rule_processor.outbox.Session', self.session_factory)
+        self.patcher.start()
+        self.processor = MagicMock()
+
+    def tearDown(self):
+        self.patcher.stop()
+        self.engine.dispose()
+        self.directory.cleanup()
+
+    def statuses(self):
+        with self.session_factory() as session:
+            return {item.email_id: item.status for item in session.query(ActionOutbox)}
+
+    def test_drain(self):
+        stats = OutboxWorker(self.processor).drain()
+
+        self.assertEqual(stats, {'done': 3})
+        self.assertEqual(set(self.statuses().values()), {'done'})
+
+    def test_run_batch_keeps_outcomes_of_a_crashed_batch(self):
+        self.processor.apply_action.side_effect = [None, KeyboardInterrupt]
+
+        with self.assertRaises(KeyboardInterrupt):
+            OutboxWorker(self.processor).run_batch()
+
+        # Only the action in flight is applied again, once its claim expires
+        self.assertEqual(self.statuses(), {'message_id_0': 'done', 'message_id_1': 'in_progress',
+                                           'message_id_2': 'in_progress'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,177 @@
+import datetime
+import os
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import MagicMock, patch
+
+from sqlalchemy.orm import sessionmaker
+
+import process_email
+from db.backends import SQLiteBackend
+from db.models import ActionOutbox, Email, RuleWatermark, RuleWorkItem
+from fetch_email import GmailClient
+from rule_processor.parallel import (claim_work_item, enqueue_work, merge_results, process_rules_parallel,
+                                     run_worker, seq_ranges)
+
+
+class TestParallel(unittest.TestCase):
+
+    def test_claim_work_item_skips_locked_rows(self):
+        session = MagicMock()
+        query = session.query.return_value.filter.return_value.order_by.return_value
+
+        claim_work_item(session, 'run')
+
+        query.with_for_update.assert_called_once_with(skip_locked=True)
+
+    def test_merge_results(self):
+        totals = merge_results([{1: 2, 2: 1}, {1: 3}, {}])
+        self.assertEqual(totals, {1: 5, 2: 1})
+
+    @patch('process_email.process_rules_parallel')
+    @patch('process_email.GmailClient.get_credentials')
+    @patch('process_email.RuleProcessor.read_rule_json', return_value=[{'id': 1}])
+    def test_main_authenticates_once_for_all_workers(self, mock_rules, mock_get_credentials, mock_parallel):
+        with patch.object(process_email.backend, 'supports_skip_locked', True):
+            process_email.main(workers=4)
+
+        mock_get_credentials.assert_called_once_with()
+        service_factory = mock_parallel.call_args.args[1]
+        self.assertIs(service_factory.func, GmailClient.build_service)
+        self.assertEqual(service_factory.args, (mock_get_credentials.return_value,))
+
+
+class TestParallelRun(unittest.TestCase):
+    """
+    Runs workers against an SQLite database. SQLite has no SKIP LOCKED, so only one worker runs at a time.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.backend = SQLiteBackend()
+        self.engine = self.backend.create_engine(f"sqlite:///{os.path.join(self.directory.name, 'happyfox.db')}")
+        self.backend.ensure_schema(self.engine)
+
+        now = datetime.datetime.now()
+        with self.engine.begin() as connection:
+            self.backend.upsert_emails(connection, [
+                {'id': f'message_id_{n}', 'from_address': 'billing@canarabank.com' if n % 2 else 'friend@example.org',
+                 'to_address': 'me@example.com', 'subject': f'Statement {n}', 'date_received': now}
+                for n in range(10)])
+
+        self.session_factory = sessionmaker(bind=self.engine)
+        self.patches = [patch('rule_processor.parallel.Session', self.session_factory),
+                        patch('rule_processor.outbox.Session', self.session_factory),
+                        patch('rule_processor.parallel.default_backend', self.backend)]
+        for patcher in self.patches:
+            patcher.start()
+
+        self.gmail_service = MagicMock()
+        self.rules = [
+            {'id': 1, 'conditions': [{'field': 'From', 'predicate': 'Contains', 'value': 'canarabank'}],
+             'actions': [{'action': 'Mark as read'}]},
+            {'id': 2, 'conditions': [{'field': 'Subject', 'predicate': 'Equals', 'value': 'Statement 4'}],
+             'actions': [{'action': 'Mark as unread'}]}
+        ]
+
+    def tearDown(self):
+        for patcher in self.patches:
+            patcher.stop()
+        self.engine.dispose()
+        self.directory.cleanup()
+
+    def service_factory(self):
+        return self.gmail_service
+
+    def test_seq_ranges(self):
+        with self.session_factory() as session:
+            # The ten emails have ingest_seq 1 to 10
+            self.assertEqual(seq_ranges(session, Email.ingest_seq <= 10, 10, 4), [(0, 3), (3, 6), (6, 8), (8, 10)])
+            # Ranges hold about the same number of emails in scope, wherever they are
+            self.assertEqual(seq_ranges(session, Email.ingest_seq > 7, 10, 4), [(0, 8), (8, 9), (9, 10)])
+            self.assertEqual(seq_ranges(session, Email.ingest_seq > 10, 10, 4), [(0, 10)])
+
+    def test_run_worker(self):
+        enqueue_work('run', self.rules, [(0, 3), (3, 6), (6, 8), (8, 10)])
+
+        results = run_worker('run', self.rules, self.service_factory, 'worker', 10, datetime.datetime.now(), {})
+
+        self.assertEqual(results, {1: 5, 2: 1})
+        with self.session_factory() as session:
+            items = session.query(RuleWorkItem).all()
+            self.assertEqual(len(items), 8)
+            self.assertTrue(all(item.status == 'done' and item.worker == 'worker' for item in items))
+            self.assertEqual(sum(item.matched for item in items), 6)
+
+            # Every range is claimed once, so every match is queued and applied exactly once
+            outbox = session.query(ActionOutbox).all()
+            self.assertEqual(sorted((row.rule_id, row.email_id) for row in outbox),
+                             sorted([('1', f'message_id_{n}') for n in range(1, 10, 2)] + [('2', 'message_id_4')]))
+            self.assertTrue(all(row.status == 'done' for row in outbox))
+        self.assertEqual(self.gmail_service.users().messages().modify.call_count, 6)
+
+    @patch('rule_processor.parallel.ProcessPoolExecutor', ThreadPoolExecutor)
+    def test_process_rules_parallel(self):
+        totals = process_rules_parallel(self.rules, self.service_factory, workers=1, buckets=3)
+
+        # Without apply_options the actions are left for standalone apply workers
+        self.gmail_service.users().messages().modify.assert_not_called()
+
+        self.assertEqual(totals, {1: 5, 2: 1})
+        with self.session_factory() as session:
+            self.assertEqual(session.query(RuleWorkItem).count(), 0)
+            self.assertEqual({watermark.rule_id: watermark.last_seq for watermark in session.query(RuleWatermark)},
+                             {'1': 10, '2': 10})
+
+    @patch('rule_processor.parallel.ProcessPoolExecutor', ThreadPoolExecutor)
+    def test_process_rules_parallel_holds_watermark_of_unresolved_bodies(self):
+        # The mocked service returns no bodies, so the body condition of every candidate stays unresolved
+        self.rules.append({'id': 3, 'conditions': [{'field': 'From', 'predicate': 'Contains', 'value': 'canarabank'},
+                                                   {'field': 'Body', 'predicate': 'Contains', 'value': 'invoice'}],
+                           'actions': [{'action': 'Mark as read'}]})
+
+        with patch.dict(os.environ, {'BODY_CACHE_DIR': self.directory.name}):
+            totals = process_rules_parallel(self.rules, self.service_factory, workers=1, buckets=3)
+
+        self.assertEqual(totals, {1: 5, 2: 1, 3: 0})
+        with self.session_factory() as session:
+            # message_id_1, the first canarabank email, has ingest_seq 2
+            self.assertEqual({watermark.rule_id: watermark.last_seq for watermark in session.query(RuleWatermark)},
+                             {'1': 10, '2': 10, '3': 1})
+
+    @patch('rule_processor.parallel.ProcessPoolExecutor', ThreadPoolExecutor)
+    def test_process_rules_parallel_shares_rate_limit(self):
+        # Match for real, but leave the actions in the outbox
+        with patch('rule_processor.parallel.run_worker',
+                   side_effect=lambda *args: run_worker(*args[:-1])) as mock_run_worker:
+            process_rules_parallel(self.rules, self.service_factory, workers=4,
+                                   apply_options={'rate_limit': 10, 'batch_size': 20})
+
+        self.assertEqual({call.args[-1]['rate_limit'] for call in mock_run_worker.call_args_list}, {2.5})
+        self.assertEqual({call.args[-1]['batch_size'] for call in mock_run_worker.call_args_list}, {20})
+
+    @patch('rule_processor.parallel.ProcessPoolExecutor', ThreadPoolExecutor)
+    def test_process_rules_parallel_deletes_work_of_failed_run(self):
+        with patch('rule_processor.parallel.run_worker', side_effect=RuntimeError("Worker crashed")):
+            with self.assertRaises(RuntimeError):
+                process_rules_parallel(self.rules, self.service_factory, workers=1)
+
+        with self.session_factory() as session:
+            self.assertEqual(session.query(RuleWorkItem).count(), 0)
+            self.assertEqual(session.query(RuleWatermark).count(), 0)
+
+    @patch('rule_processor.parallel.ProcessPoolExecutor', ThreadPoolExecutor)
+    def test_process_rules_parallel_keeps_watermarks_of_incomplete_run(self):
+        # A worker that returns without completing its items, e.g. after losing its database connection
+        with patch('rule_processor.parallel.run_worker', return_value={}):
+            with self.assertRaises(RuntimeError):
+                process_rules_parallel(self.rules, self.service_factory, workers=2)
+
+        with self.session_factory() as session:
+            self.assertEqual(session.query(RuleWorkItem).count(), 0)
+            self.assertEqual(session.query(RuleWatermark).count(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,16 @@
+import base64
 import datetime
 import unittest
 from unittest.mock import patch, MagicMock, mock_open
 
+from googleapiclient.errors import HttpError
+from sqlalchemy import select
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import DataError
+
+from db.backends import PostgresBackend, SQLiteBackend
+from db.models import Email
+from rule_processor.exceptions import PermanentActionError
 from rule_processor.rule_processor import RuleProcessor
 
 
@@ -39,6 +48,159 @@ class TestRuleProcessor(unittest.TestCase):
         operator = self.processor.get_string_comparison_operator("Contains")
         self.assertIsNotNone(operator)
 
+    def test_get_string_comparison_operator_rich_predicates(self):
+        for predicate in ["Starts with", "Matches regex", "Matches words"]:
+            operator = self.processor.get_string_comparison_operator(predicate)
+            self.assertIsNotNone(operator)
+
+    def test_build_query_rich_predicates(self):
+        rule = {
+            "overall_predicate": "All",
+            "conditions": [
+                {"field": "Subject", "predicate": "Matches words", "value": "invoice due"},
+                {"field": "From", "predicate": "Starts with", "value": "billing"},
+                {"field": "To", "predicate": "Matches regex", "value": "^me@"}
+            ]
+        }
+        processor = RuleProcessor(self.gmail_service, backend=PostgresBackend())
+        query = processor.build_query(select(Email), rule)
+        sql = str(query.compile(dialect=postgresql.dialect()))
+
+        self.assertIn("emails.subject_search @@ plainto_tsquery", sql)
+        self.assertIn("emails.from_address LIKE", sql)
+        self.assertIn("emails.to_address ~", sql)
+        self.assertNotIn("subject_search,", sql)
+
+    def test_build_query_invalid_regex_never_matches(self):
+        rule = {
+            "overall_predicate": "All",
+            "conditions": [{"field": "Subject", "predicate": "Matches regex", "value": "(unclosed"}]
+        }
+        processor = RuleProcessor(self.gmail_service, backend=SQLiteBackend())
+        query = processor.build_query(select(Email), rule)
+        sql = str(query.compile(dialect=postgresql.dialect()))
+
+        # Dropping the only condition would match every email
+        self.assertNotIn("emails.subject ~", sql)
+        self.assertIn("WHERE false", sql)
+
+    def test_build_query_probes_regex_on_postgresql(self):
+        session = MagicMock()
+        session.execute.side_effect = DataError('SELECT', {}, Exception('invalid regular expression'))
+        query = MagicMock(session=session)
+        rule = {
+            "overall_predicate": "Any",
+            "conditions": [{"field": "Subject", "predicate": "Matches regex", "value": "(?P<n>due)"}]
+        }
+        processor = RuleProcessor(self.gmail_service, backend=PostgresBackend())
+
+        processor.build_query(query, rule)
+
+        session.begin_nested.assert_called_once()
+        self.assertEqual(str(query.filter.call_args[0][0].compile(dialect=postgresql.dialect())), 'false')
+
+    def test_apply_action_unknown_action_is_permanent(self):
+        with self.assertRaises(PermanentActionError):
+            self.processor.apply_action(self.mock_email, {'action': 'Archive'})
+
+    def test_apply_action_deleted_message_is_permanent(self):
+        self.gmail_service.users().messages().modify().execute.side_effect = HttpError(
+            MagicMock(status=404), b'Not Found')
+
+        with self.assertRaises(PermanentActionError):
+            self.processor.apply_action(self.mock_email, {'action': 'Mark as read'})
+
+    def test_apply_action_rate_limit_is_retryable(self):
+        error = HttpError(MagicMock(status=429), b'Rate Limit Exceeded')
+        self.gmail_service.users().messages().modify().execute.side_effect = error
+
+        with self.assertRaises(HttpError):
+            self.processor.apply_action(self.mock_email, {'action': 'Mark as read'})
+
+    def test_move_message_retries_when_labels_unavailable(self):
+        self.processor.available_labels = None
+        self.gmail_service.users().labels().list().execute.side_effect = Exception("Backend error")
+
+        with self.assertRaises(Exception) as context:
+            self.processor.move_message(self.mock_email, 'Important')
+        self.assertNotIsInstance(context.exception, PermanentActionError)
+
+    def test_move_message_missing_label_is_permanent(self):
+        self.processor.available_labels = [{'id': 'label_id_1', 'name': 'Label1'}]
+
+        with self.assertRaises(PermanentActionError):
+            self.processor.move_message(self.mock_email, 'Important')
+
+    def test_parse_message_body(self):
+        payload = {
+            'mimeType': 'multipart/mixed',
+            'parts': [
+                {'mimeType': 'multipart/alternative', 'parts': [
+                    {'mimeType': 'text/plain', 'body': {'data': base64.urlsafe_b64encode(b'Invoice due').decode()}},
+                    {'mimeType': 'text/html', 'body': {'data': base64.urlsafe_b64encode(b'<p>Invoice</p>').decode()}}
+                ]},
+                {'mimeType': 'application/pdf', 'filename': 'invoice.pdf', 'body': {'attachmentId': 'attachment_1'}}
+            ]
+        }
+        body, has_attachment = RuleProcessor.parse_message_body(payload)
+
+        self.assertEqual(body, b'Invoice due')
+        self.assertTrue(has_attachment)
+
+    def test_match_emails_fetches_bodies_of_candidates_only(self):
+        candidate = MagicMock(id='message_id_1')
+        self.processor.body_cache = MagicMock()
+        self.processor.body_cache.get.return_value = None
+        self.processor.body_cache.contains.return_value = True
+        self.processor.fetch_bodies = MagicMock()
+        self.mock_query.filter.return_value.all.return_value = [candidate]
+        rule = {
+            "overall_predicate": "All",
+            "conditions": [
+                {"field": "From", "predicate": "Contains", "value": "billing"},
+                {"field": "Body", "predicate": "Contains", "value": "invoice"}
+            ]
+        }
+
+        emails = self.processor.match_emails(self.mock_query, rule)
+
+        self.assertEqual(emails, [candidate])
+        self.processor.fetch_bodies.assert_called_once_with(['message_id_1'])
+        self.processor.body_cache.contains.assert_called_once_with('message_id_1', b'invoice')
+
+    def test_match_emails_reports_unresolved_bodies(self):
+        fetched, missing = MagicMock(id='message_id_1'), MagicMock(id='message_id_2')
+        self.processor.body_cache = MagicMock()
+        self.processor.body_cache.get.side_effect = lambda message_id: None if message_id == 'message_id_2' else {}
+        self.processor.body_cache.contains.side_effect = lambda message_id, needle: (
+            None if message_id == 'message_id_2' else True)
+        self.processor.fetch_bodies = MagicMock()
+        self.mock_query.all.return_value = [fetched, missing]
+        rule = {
+            "overall_predicate": "Any",
+            "conditions": [{"field": "Body", "predicate": "Contains", "value": "invoice"}]
+        }
+        unresolved = []
+
+        emails = self.processor.match_emails(self.mock_query, rule, unresolved=unresolved)
+
+        self.assertEqual(emails, [fetched])
+        self.assertEqual(unresolved, [missing])
+        self.processor.fetch_bodies.assert_called_once_with(['message_id_2'])
+
+    def test_save_watermark(self):
+        session = MagicMock()
+        now = datetime.datetime.now()
+        rule = {'id': 1, 'conditions': [{'field': 'Body', 'predicate': 'Contains', 'value': 'invoice'}]}
+
+        RuleProcessor.save_watermark(session, rule, 10, now)
+        self.assertEqual(session.merge.call_args[0][0].last_seq, 10)
+
+        # Held just below the lowest email whose body could not be fetched
+        RuleProcessor.save_watermark(session, rule, 10, now, unresolved_seq=4)
+        self.assertEqual(session.merge.call_args[0][0].last_seq, 3)
+        self.assertEqual(session.merge.call_args[0][0].evaluated_at, now)
+
     def test_get_date_comparison_operator(self):
         operator = self.processor.get_date_comparison_operator("Less than")
         self.assertIsNotNone(operator)
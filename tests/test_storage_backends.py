@@ -0,0 +1,386 @@
+import datetime
+import logging
+import os
+import tempfile
+import time
+import unittest
+from unittest.mock import MagicMock, patch
+
+from sqlalchemy.orm import sessionmaker
+
+from db.backends import PostgresBackend, SQLiteBackend, StorageBackend, get_backend
+from db.models import ActionOutbox, Base, Email, RuleWatermark
+from rule_processor.outbox import claim_batch, enqueue_actions
+from rule_processor.rule_processor import RuleProcessor
+
+NOW = datetime.datetime.now().replace(microsecond=0)
+
+EMAILS = [
+    {'id': 'message_id_1', 'from_address': 'Billing <billing@canarabank.com>', 'to_address': 'me@example.com',
+     'subject': 'Your invoice is due', 'date_received': NOW - datetime.timedelta(days=1)},
+    {'id': 'message_id_2', 'from_address': 'Alerts <alerts@canarabank.com>', 'to_address': 'me@example.com',
+     'subject': 'Security alert: new login', 'date_received': NOW - datetime.timedelta(days=10)},
+    {'id': 'message_id_3', 'from_address': 'friend@example.org', 'to_address': 'me@example.com',
+     'subject': 'Invoice for dinner', 'date_received': NOW - datetime.timedelta(days=40)},
+]
+
+
+class BackendConformance:
+    """
+    Rule semantics every storage backend must share. Subclasses provide the backend and database URI.
+    """
+    backend = None
+    uri = None
+
+    @classmethod
+    def setUpClass(cls):
+        cls.engine = cls.backend.create_engine(cls.uri)
+        Base.metadata.drop_all(cls.engine)
+        cls.create_schema()
+        with cls.engine.begin() as connection:
+            cls.backend.upsert_emails(connection, EMAILS)
+        cls.session_factory = sessionmaker(bind=cls.engine)
+
+    @classmethod
+    def create_schema(cls):
+        cls.backend.ensure_schema(cls.engine)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.engine.dispose()
+
+    def setUp(self):
+        self.processor = RuleProcessor(MagicMock(), backend=self.backend)
+
+    def match(self, *conditions, overall_predicate='All'):
+        rule = {'overall_predicate': overall_predicate, 'conditions': list(conditions)}
+        with self.session_factory() as session:
+            return sorted(email.id for email in self.processor.match_emails(session.query(Email), rule))
+
+    def test_contains_is_case_sensitive(self):
+        self.assertEqual(self.match({'field': 'Subject', 'predicate': 'Contains', 'value': 'nvoice'}),
+                         ['message_id_1', 'message_id_3'])
+        self.assertEqual(self.match({'field': 'Subject', 'predicate': 'Contains', 'value': 'INVOICE'}), [])
+
+    def test_does_not_contain(self):
+        self.assertEqual(self.match({'field': 'From', 'predicate': 'Does not Contain', 'value': 'canarabank'}),
+                         ['message_id_3'])
+
+    def test_equals(self):
+        self.assertEqual(self.match({'field': 'From', 'predicate': 'Equals', 'value': 'friend@example.org'}),
+                         ['message_id_3'])
+
+    def test_starts_with(self):
+        self.assertEqual(self.match({'field': 'Subject', 'predicate': 'Starts with', 'value': 'Invoice'}),
+                         ['message_id_3'])
+        self.assertEqual(self.match({'field': 'Subject', 'predicate': 'Starts with', 'value': 'invoice'}), [])
+        # LIKE wildcards in the value are not wildcards
+        self.assertEqual(self.match({'field': 'Subject', 'predicate': 'Starts with', 'value': 'Invoice_for'}), [])
+        self.assertEqual(self.match({'field': 'Subject', 'predicate': 'Starts with', 'value': '%invoice'}), [])
+
+    def test_matches_regex(self):
+        self.assertEqual(self.match({'field': 'Subject', 'predicate': 'Matches regex', 'value': '^(Your|Security) '}),
+                         ['message_id_1', 'message_id_2'])
+
+    def test_invalid_regex_never_matches(self):
+        invalid = {'field': 'Subject', 'predicate': 'Matches regex', 'value': '(unclosed'}
+        self.assertEqual(self.match(invalid), [])
+        self.assertEqual(self.match(invalid, {'field': 'Subject', 'predicate': 'Contains', 'value': 'alert'},
+                                    overall_predicate='Any'),
+                         ['message_id_2'])
+
+    def test_matches_words(self):
+        self.assertEqual(self.match({'field': 'Subject', 'predicate': 'Matches words', 'value': 'INVOICE due'}),
+                         ['message_id_1'])
+        self.assertEqual(self.match({'field': 'Subject', 'predicate': 'Matches words', 'value': 'invoice'}),
+                         ['message_id_1', 'message_id_3'])
+
+    def test_matches_words_on_addresses(self):
+        # Addresses split into words on every backend
+        self.assertEqual(self.match({'field': 'From', 'predicate': 'Matches words', 'value': 'friend'}),
+                         ['message_id_3'])
+        self.assertEqual(self.match({'field': 'From', 'predicate': 'Matches words', 'value': 'example'}),
+                         ['message_id_3'])
+        self.assertEqual(self.match({'field': 'From', 'predicate': 'Matches words', 'value': 'friend@example.org'}),
+                         ['message_id_3'])
+        self.assertEqual(self.match({'field': 'From', 'predicate': 'Matches words', 'value': 'canarabank.com'}),
+                         ['message_id_1', 'message_id_2'])
+        self.assertEqual(self.match({'field': 'To', 'predicate': 'Matches words', 'value': 'ME'}),
+                         ['message_id_1', 'message_id_2', 'message_id_3'])
+        self.assertEqual(self.match({'field': 'To', 'predicate': 'Matches words', 'value': 'example.org'}), [])
+
+    def test_matches_words_punctuation(self):
+        self.assertEqual(self.match({'field': 'Subject', 'predicate': 'Matches words', 'value': 'alert: new_login!'}),
+                         ['message_id_2'])
+        self.assertEqual(self.match({'field': 'Subject', 'predicate': 'Matches words', 'value': '"* OR -'}), [])
+
+    def test_received(self):
+        self.assertEqual(self.match({'field': 'Received', 'predicate': 'Less than', 'value': '30 days'}),
+                         ['message_id_3'])
+        self.assertEqual(self.match({'field': 'Received', 'predicate': 'Greater than', 'value': '5 days'}),
+                         ['message_id_1'])
+
+    def test_overall_predicate_any(self):
+        self.assertEqual(self.match({'field': 'Subject', 'predicate': 'Contains', 'value': 'alert'},
+                                    {'field': 'Received', 'predicate': 'Less than', 'value': '30 days'},
+                                    overall_predicate='Any'),
+                         ['message_id_2', 'message_id_3'])
+
+    def test_upsert_updates_existing_rows(self):
+        updated = dict(EMAILS[2], subject='Invoice for lunch')
+        with self.engine.begin() as connection:
+            self.backend.upsert_emails(connection, [updated])
+        try:
+            self.assertEqual(self.match({'field': 'Subject', 'predicate': 'Matches words', 'value': 'lunch'}),
+                             ['message_id_3'])
+            self.assertEqual(self.match({'field': 'Subject', 'predicate': 'Matches words', 'value': 'dinner'}), [])
+        finally:
+            with self.engine.begin() as connection:
+                self.backend.upsert_emails(connection, [EMAILS[2]])
+
+    def ingest_seqs(self):
+        with self.session_factory() as session:
+            return dict(session.query(Email.id, Email.ingest_seq))
+
+    def test_ingest_seq_moves_only_on_change(self):
+        before = self.ingest_seqs()
+        self.assertEqual(len(set(before.values())), len(EMAILS))
+
+        with self.engine.begin() as connection:
+            self.backend.upsert_emails(connection, EMAILS)
+        self.assertEqual(self.ingest_seqs(), before)
+
+        with self.engine.begin() as connection:
+            self.backend.upsert_emails(connection, [dict(EMAILS[0], subject='Your invoice is overdue')])
+        try:
+            after = self.ingest_seqs()
+            self.assertGreater(after['message_id_1'], max(before.values()))
+            self.assertEqual(after['message_id_2'], before['message_id_2'])
+        finally:
+            with self.engine.begin() as connection:
+                self.backend.upsert_emails(connection, [EMAILS[0]])
+
+    def process(self, *rules):
+        """
+        Runs process_rules on the test database and returns the (rule id, email id) pairs it queued.
+        """
+        with patch('rule_processor.rule_processor.Session', self.session_factory):
+            self.processor.process_rules(list(rules))
+        with self.session_factory() as session:
+            queued = session.query(ActionOutbox)
+            pairs = sorted((row.rule_id, row.email_id) for row in queued)
+            queued.delete()
+            session.commit()
+        return pairs
+
+    def watermarks(self):
+        with self.session_factory() as session:
+            return {watermark.rule_id: watermark.last_seq for watermark in session.query(RuleWatermark)}
+
+    def tearDown(self):
+        with self.session_factory() as session:
+            session.query(ActionOutbox).delete()
+            session.query(RuleWatermark).delete()
+            session.commit()
+
+    def test_incremental_evaluation(self):
+        rule = {'id': 'incremental', 'overall_predicate': 'All',
+                'conditions': [{'field': 'Subject', 'predicate': 'Contains', 'value': 'nvoice'}],
+                'actions': [{'action': 'Mark as read'}]}
+        new_email = {'id': 'message_id_4', 'from_address': 'shop@example.com', 'to_address': 'me@example.com',
+                     'subject': 'Invoice #42', 'date_received': NOW}
+        try:
+            self.assertEqual(self.process(rule), [('incremental', 'message_id_1'), ('incremental', 'message_id_3')])
+            self.assertEqual(self.watermarks(), {'incremental': max(self.ingest_seqs().values())})
+            self.assertEqual(self.process(rule), [])
+
+            with self.engine.begin() as connection:
+                self.backend.upsert_emails(connection, [new_email])
+            self.assertEqual(self.process(rule), [('incremental', 'message_id_4')])
+
+            # A changed rule definition is evaluated against every email again
+            rule['conditions'][0]['value'] = 'Invoice'
+            self.assertEqual(self.process(rule), [('incremental', 'message_id_3'), ('incremental', 'message_id_4')])
+        finally:
+            with self.engine.begin() as connection:
+                connection.execute(Email.__table__.delete().where(Email.id == new_email['id']))
+
+    def test_incremental_evaluation_snapshot(self):
+        rule = {'id': 'all', 'overall_predicate': 'All',
+                'conditions': [{'field': 'To', 'predicate': 'Contains', 'value': 'me@'}],
+                'actions': [{'action': 'Mark as read'}]}
+        seqs = self.ingest_seqs()
+
+        # Emails ingested after the snapshot are left to the next run
+        with patch.object(self.backend, 'ingest_snapshot', return_value=seqs['message_id_2']):
+            self.assertEqual(self.process(rule), [('all', 'message_id_1'), ('all', 'message_id_2')])
+        self.assertEqual(self.watermarks(), {'all': seqs['message_id_2']})
+
+        self.assertEqual(self.process(rule), [('all', 'message_id_3')])
+        self.assertEqual(self.watermarks(), {'all': seqs['message_id_3']})
+
+    def test_incremental_evaluation_date_window(self):
+        rule = {'id': 'older_than_5_days', 'overall_predicate': 'All',
+                'conditions': [{'field': 'Received', 'predicate': 'Less than', 'value': '5 days'}],
+                'actions': [{'action': 'Mark as read'}]}
+        self.process(rule)
+        with self.session_factory() as session:
+            session.get(RuleWatermark, 'older_than_5_days').evaluated_at = NOW - datetime.timedelta(days=20)
+            session.commit()
+
+        # Only emails that crossed the threshold since the last evaluation are matched again
+        self.assertEqual(self.process(rule), [('older_than_5_days', 'message_id_2')])
+
+    def test_watermark_commits_with_queued_actions(self):
+        completed = {'id': 'completed',
+                     'conditions': [{'field': 'Subject', 'predicate': 'Contains', 'value': 'nvoice'}],
+                     'actions': [{'action': 'Mark as read'}]}
+        failing = {'id': 'failing', 'conditions': [{'field': 'To', 'predicate': 'Contains', 'value': 'me@'}],
+                   'actions': [{'action': 'Mark as read'}]}
+
+        def enqueue_then_fail(session, email, rule):
+            enqueue_actions(session, email, rule)
+            if rule['id'] == 'failing':
+                raise RuntimeError("Connection lost")
+
+        with patch('rule_processor.rule_processor.enqueue_actions', side_effect=enqueue_then_fail):
+            with self.assertRaises(RuntimeError):
+                self.process(completed, failing)
+
+        # The failed rule left neither queued actions nor a watermark behind
+        with self.session_factory() as session:
+            self.assertEqual(sorted((row.rule_id, row.email_id) for row in session.query(ActionOutbox)),
+                             [('completed', 'message_id_1'), ('completed', 'message_id_3')])
+        self.assertEqual(list(self.watermarks()), ['completed'])
+
+    def test_claim_batch(self):
+        rule = {'id': 'claim', 'actions': [{'action': 'Mark as read'}]}
+        with self.session_factory() as session:
+            for email in session.query(Email).order_by(Email.id):
+                enqueue_actions(session, email, rule)
+            session.commit()
+
+            first = claim_batch(session, 2, lease_seconds=60)
+            second = claim_batch(session, 2, lease_seconds=60)
+
+            # Claimed actions are committed in progress and never handed to another worker
+            self.assertEqual([item.email_id for item in first], ['message_id_1', 'message_id_2'])
+            self.assertEqual([item.email_id for item in second], ['message_id_3'])
+            self.assertEqual(claim_batch(session, 2, lease_seconds=60), [])
+            with self.session_factory() as other:
+                self.assertEqual({item.status for item in other.query(ActionOutbox)}, {'in_progress'})
+
+            # The actions of a worker that died are claimed again once the lease expired
+            session.query(ActionOutbox).filter(ActionOutbox.email_id == 'message_id_3').update(
+                {'available_at': NOW - datetime.timedelta(seconds=1)})
+            session.commit()
+            self.assertEqual([item.email_id for item in claim_batch(session, 2, lease_seconds=60)],
+                             ['message_id_3'])
+
+    @unittest.skipUnless(os.environ.get('RUN_BENCHMARKS'), 'Set RUN_BENCHMARKS=1 to run benchmarks')
+    def test_benchmark(self):
+        count = 20000
+        rows = [{'id': f'bench_{n}', 'from_address': f'sender{n % 500}@example.com', 'to_address': 'me@example.com',
+                 'subject': f'Report {n} weekly summary', 'date_received': NOW - datetime.timedelta(minutes=n)}
+                for n in range(count)]
+        try:
+            started = time.perf_counter()
+            with self.engine.begin() as connection:
+                for start in range(0, count, 1000):
+                    self.backend.upsert_emails(connection, rows[start:start + 1000])
+            upsert_seconds = time.perf_counter() - started
+
+            for predicate, value in [('Contains', 'sender42@'), ('Starts with', 'Report 1999'),
+                                     ('Matches words', 'report 12345')]:
+                field = 'From' if predicate == 'Contains' else 'Subject'
+                started = time.perf_counter()
+                matched = self.match({'field': field, 'predicate': predicate, 'value': value})
+                logging.info(f"{self.backend.name} {predicate}: {(time.perf_counter() - started) * 1000:.1f} ms")
+                self.assertTrue(matched)
+            logging.info(f"{self.backend.name} upsert of {count} emails: {upsert_seconds:.2f} s")
+        finally:
+            with self.engine.begin() as connection:
+                connection.execute(Email.__table__.delete().where(Email.id.like('bench_%')))
+
+
+class TestGetBackend(unittest.TestCase):
+    def test_get_backend(self):
+        self.assertIsInstance(get_backend('sqlite:///happyfox.db'), SQLiteBackend)
+        self.assertIsInstance(get_backend('postgresql+psycopg2://localhost/happyfox'), PostgresBackend)
+        with self.assertRaises(ValueError):
+            get_backend('mysql://localhost/happyfox')
+
+    def test_storage_backend_is_abstract(self):
+        with self.assertRaises(TypeError):
+            StorageBackend()
+
+
+class TestSQLiteBackend(BackendConformance, unittest.TestCase):
+    backend = SQLiteBackend()
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.TemporaryDirectory()
+        cls.uri = f"sqlite:///{os.path.join(cls.directory.name, 'happyfox.db')}"
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.directory.cleanup()
+
+    def test_ensure_schema_upgrades_existing_database(self):
+        engine = self.backend.create_engine(f"sqlite:///{os.path.join(self.directory.name, 'v1.db')}")
+        try:
+            with engine.begin() as connection:
+                connection.exec_driver_sql('CREATE TABLE emails (id VARCHAR PRIMARY KEY, from_address VARCHAR, '
+                                           'to_address VARCHAR, subject VARCHAR, date_received DATETIME)')
+                connection.exec_driver_sql("INSERT INTO emails (id, subject) VALUES ('a', 'Monthly statement'), "
+                                           "('b', 'Weekly digest')")
+
+            self.backend.ensure_schema(engine)
+            self.backend.ensure_schema(engine)
+
+            with engine.connect() as connection:
+                rows = connection.exec_driver_sql('SELECT id, ingest_seq FROM emails ORDER BY id').fetchall()
+            self.assertEqual(rows, [('a', 1), ('b', 2)])
+
+            # Emails stored before the upgrade are found by full text search
+            rule = {'conditions': [{'field': 'Subject', 'predicate': 'Matches words', 'value': 'statement'}]}
+            with sessionmaker(bind=engine)() as session:
+                emails = self.processor.match_emails(session.query(Email), rule)
+            self.assertEqual([email.id for email in emails], ['a'])
+        finally:
+            engine.dispose()
+
+    def test_matches_regex_with_python_syntax(self):
+        self.assertEqual(self.match({'field': 'Subject', 'predicate': 'Matches regex', 'value': r'(?P<w>\bnew\b)'}),
+                         ['message_id_2'])
+        self.assertEqual(self.match({'field': 'Subject', 'predicate': 'Matches regex', 'value': r'\mnew\M'}), [])
+
+    def test_pragmas(self):
+        with self.engine.connect() as connection:
+            self.assertEqual(connection.exec_driver_sql('PRAGMA journal_mode').scalar(), 'wal')
+            self.assertEqual(connection.exec_driver_sql('PRAGMA synchronous').scalar(), 1)
+
+
+@unittest.skipUnless(os.environ.get('TEST_DATABASE_URL'), 'Set TEST_DATABASE_URL to a disposable PostgreSQL database')
+class TestPostgresBackend(BackendConformance, unittest.TestCase):
+    backend = PostgresBackend()
+    uri = os.environ.get('TEST_DATABASE_URL')
+
+    def test_matches_regex_with_postgresql_syntax(self):
+        self.assertEqual(self.match({'field': 'Subject', 'predicate': 'Matches regex', 'value': r'\mnew\M'}),
+                         ['message_id_2'])
+        self.assertEqual(self.match({'field': 'Subject', 'predicate': 'Matches regex', 'value': r'\ydue'}),
+                         ['message_id_1'])
+        self.assertEqual(self.match({'field': 'Subject', 'predicate': 'Matches regex', 'value': '(?P<w>new)'}), [])
+
+    @classmethod
+    def create_schema(cls):
+        # The PostgreSQL schema is normally created by the Alembic migrations
+        Base.metadata.create_all(cls.engine)
+
+
+if __name__ == '__main__':
+    unittest.main()